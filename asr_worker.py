@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import signal
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Shared audio buffer size: 2 minutes at 16 kHz (longer clips go through the queue)
+SAMPLE_RATE = 16000
+MAX_SAMPLES = SAMPLE_RATE * 120
+
+# Short Spanish utterances don't need "base"; the multilingual "tiny" model is
+# several times faster on CPU. Any faster-whisper model name or path works here
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "tiny")
+
+# While waiting on the worker, check this often (seconds) that it is still alive
+WORKER_POLL_SECONDS = 1.0
+
+
+def whisper_device_settings():
+    """Pick the CTranslate2 device and precision for faster-whisper"""
+    # Imported here, not at module level: only the worker process needs the
+    # CTranslate2/faster-whisper stack, the chat process just imports WhisperProcess
+    import ctranslate2
+
+    # CTranslate2 already decodes with a preallocated KV cache and fused
+    # attention kernels; on a GPU use them with int8 weights / fp16 compute
+    if ctranslate2.get_cuda_device_count() > 0:
+        return "cuda", "int8_float16"
+    return "cpu", "int8"
+
+
+def load_whisper_model():
+    """Load the faster-whisper model on the best available device"""
+    from faster_whisper import WhisperModel
+
+    device, compute_type = whisper_device_settings()
+    options = dict(device=device, compute_type=compute_type, cpu_threads=os.cpu_count())
+
+    if device == "cuda":
+        # Flash attention for the encoder's 1500-frame context; needs a recent
+        # CTranslate2 and GPU, otherwise fall back to the regular kernels
+        try:
+            return WhisperModel(WHISPER_MODEL, flash_attention=True, **options)
+        except (TypeError, ValueError, RuntimeError):
+            pass
+
+    return WhisperModel(WHISPER_MODEL, **options)
+
+
+def transcribe_segments(model, audio):
+    """Lazily decode a 16 kHz mono float32 buffer, yielding each segment's text"""
+    segments, _ = model.transcribe(
+        audio,
+        language="es",
+        task="transcribe",
+        beam_size=1,
+        best_of=1,
+        # Short one-shot utterances: no timestamp tokens to decode and no
+        # prompt carried over from previous windows
+        without_timestamps=True,
+        condition_on_previous_text=False,
+        # Trim pauses longer than 300 ms before encoding so less padding and
+        # silence reaches the encoder
+        vad_filter=True,
+        vad_parameters=dict(min_silence_duration_ms=300)
+    )
+    for segment in segments:
+        yield segment.text
+
+
+def warm_up(model):
+    """Run a throwaway inference so the first real request hits a warm model"""
+    # One second of silence; VAD would drop it, so decode it unfiltered
+    segments, _ = model.transcribe(
+        np.zeros(SAMPLE_RATE, dtype=np.float32),
+        language="es",
+        beam_size=1
+    )
+    for _ in segments:
+        pass
+
+
+def whisper_worker(shm_name, requests, responses):
+    """Worker process: load Whisper once, then serve transcription requests"""
+    # Ctrl+C is handled by the chat process, which shuts the worker down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffer = np.ndarray((MAX_SAMPLES,), dtype=np.float32, buffer=shm.buf)
+
+    try:
+        model = load_whisper_model()
+        warm_up(model)
+        responses.put("ready")
+    except Exception as e:
+        responses.put(RuntimeError(f"No se pudo cargar Whisper: {e}"))
+        shm.close()
+        return
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+
+        try:
+            # Normally just a sample count for the shared buffer; oversized
+            # clips arrive as an array through the queue instead
+            audio = buffer[:request] if isinstance(request, int) else request
+            # Send each segment as soon as it is decoded, then the end marker
+            for text in transcribe_segments(model, audio):
+                responses.put(text)
+            responses.put(None)
+        except Exception as e:
+            responses.put(RuntimeError(str(e)))
+
+    del buffer
+    shm.close()
+
+
+class WhisperProcess:
+    """Whisper running in its own process, fed audio through shared memory
+
+    If the worker dies (OOM kill, segfault, CUDA abort) the waiting call
+    raises instead of hanging, and the next transcription spawns a fresh
+    worker. A CUDA out-of-memory error also retires the worker so its GPU
+    memory is released before the restart.
+    """
+
+    def __init__(self):
+        self._ctx = mp.get_context("spawn")
+
+        self._shm = shared_memory.SharedMemory(create=True, size=MAX_SAMPLES * np.dtype(np.float32).itemsize)
+        self._buffer = np.ndarray((MAX_SAMPLES,), dtype=np.float32, buffer=self._shm.buf)
+        self._process = None
+
+        self._start()
+
+    def _start(self):
+        """Spawn the worker and wait until the model is loaded and warmed up"""
+        # Fresh queues: a dead worker may have left partial results behind
+        self._requests = self._ctx.Queue()
+        self._responses = self._ctx.Queue()
+
+        self._process = self._ctx.Process(
+            target=whisper_worker,
+            args=(self._shm.name, self._requests, self._responses),
+            daemon=True
+        )
+        self._process.start()
+        self._get_response()
+
+    def _stop(self):
+        """Ask the worker to exit, terminating it if it doesn't"""
+        if self._process is not None and self._process.is_alive():
+            self._requests.put(None)
+            self._process.join(timeout=5)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+
+    def _get_response(self):
+        while True:
+            try:
+                response = self._responses.get(timeout=WORKER_POLL_SECONDS)
+                break
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(
+                        f"El proceso de Whisper terminó inesperadamente (código {self._process.exitcode})"
+                    )
+
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def transcribe(self, audio, on_segment=None):
+        """Transcribe a 16 kHz mono float32 buffer in the worker process
+
+        on_segment, if given, is called with each partial transcript as the
+        worker decodes it.
+        """
+        if not self._process.is_alive():
+            print("🔄 Reiniciando Whisper...")
+            self._start()
+
+        if len(audio) <= MAX_SAMPLES:
+            # Copy into shared memory; only the length crosses the queue
+            self._buffer[:len(audio)] = audio
+            self._requests.put(len(audio))
+        else:
+            self._requests.put(np.ascontiguousarray(audio, dtype=np.float32))
+
+        texts = []
+        try:
+            while (text := self._get_response()) is not None:
+                texts.append(text)
+                if on_segment is not None:
+                    on_segment(text.strip())
+        except RuntimeError as e:
+            if "out of memory" in str(e).lower():
+                # Restart with a clean GPU on the next request
+                self._stop()
+            raise
+
+        return " ".join(texts).strip()
+
+    def close(self):
+        """Stop the worker process and release the shared buffer"""
+        self._stop()
+
+        if self._shm is not None:
+            del self._buffer
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
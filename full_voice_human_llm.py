@@ -2,38 +2,112 @@
 
 import os
 import time
-import tempfile
 import signal
 import sys
+import atexit
+import queue
+import threading
 import re
-import json
+import hashlib
+import shutil
+import io
 from datetime import datetime
 from pathlib import Path
 import subprocess
+from collections import deque
 
+import orjson
 import sounddevice as sd
-import soundfile as sf
 import numpy as np
-import whisper
 import google.generativeai as genai
 from gtts import gTTS
 from dotenv import load_dotenv
 
+try:
+    from piper.voice import PiperVoice
+except ImportError:
+    PiperVoice = None
+
+try:
+    # piper-tts >= 1.3 takes synthesis options as a SynthesisConfig
+    from piper import SynthesisConfig
+except ImportError:
+    SynthesisConfig = None
+
+
+def piper_pcm(voice, text, length_scale=1.0):
+    """Synthesize text with a Piper voice as raw 16-bit mono PCM bytes"""
+    if SynthesisConfig is not None:
+        # 1.3 replaced synthesize_stream_raw with synthesize(), which yields AudioChunks
+        chunks = voice.synthesize(text, syn_config=SynthesisConfig(length_scale=length_scale))
+        return b"".join(chunk.audio_int16_bytes for chunk in chunks)
+    return b"".join(voice.synthesize_stream_raw(text, length_scale=length_scale))
+
+
+# Whisper runs in a separate worker process
+from asr_worker import WhisperProcess
+
+# Sentence boundaries used to hand Gemini's streamed answer to TTS early
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+|\n+')
+
+
+# Markdown removed before TTS, fused into one alternation so the text is
+# scanned once; the only capturing group that matched holds the kept text
+MARKDOWN_PATTERN = re.compile(
+    r'^\s*[-*+]\s+'                 # List items
+    r'|^\s*\d+\.\s+'                # Numbered lists
+    r'|(?s:```.*?```)'              # Code blocks
+    r'|\*\*(.+?)\*\*(?!\*)'         # Bold **text**
+    r'|\*(.*?)\*'                   # Italic *text*
+    r'|`(.*?)`'                     # Code `text`
+    r'|#{1,6}\s*'                   # Headers
+    r'|\[([^\]]+)\]\([^\)]+\)'      # Links [text](url)
+    r'|(\n\n)\n+',                  # Multiple newlines
+    re.MULTILINE
+)
+
+
+# Cheap check for any character/line start the pattern above could act on
+MARKDOWN_HINT = re.compile(r'[*`#\[]|^\s*(?:[-+]|\d+\.)\s|\n{3}', re.MULTILINE)
+
+
+def _markdown_replacement(match):
+    """Keep the inner text of a markdown match (cleaned recursively), drop the rest"""
+    if match.lastindex:
+        return MARKDOWN_PATTERN.sub(_markdown_replacement, match.group(match.lastindex))
+    return ''
+
+
+# Audio players tried in order of preference
+AUDIO_PLAYERS = ['mpg123', 'mpv', 'vlc', 'ffplay']
+
 
 class FullVoiceChatBot:
-    def __init__(self, sample_rate=16000, channels=1):
+    def __init__(self, sample_rate=16000, channels=1, audio_player=None):
         # Audio settings
         self.sample_rate = sample_rate
         self.channels = channels
+
+        # Player and ffmpeg are resolved once here instead of probed on every answer
+        self.audio_player = audio_player or next(
+            (player for player in AUDIO_PLAYERS if shutil.which(player)), None
+        )
+        self.ffmpeg_available = shutil.which('ffmpeg') is not None
         self.recording = False
-        self.audio_data = []
+
+        # Preallocated mono recording buffer (60 s, grown if needed) written in
+        # place by the audio callback, plus the current write position
+        self._rec_buf = np.empty(60 * sample_rate, dtype=np.float32)
+        self._rec_pos = 0
 
         # Load environment variables
         load_dotenv()
 
-        # Initialize Whisper for speech-to-text
+        # Initialize Whisper for speech-to-text in its own process, so inference
+        # never competes with audio capture for this process's GIL
         print("🤖 Cargando Whisper...")
-        self.whisper_model = whisper.load_model("base")
+        self.whisper = WhisperProcess()
+        atexit.register(self.whisper.close)
 
         # Initialize Gemini for chat
         self.api_key = os.getenv('API_KEY_GEMINI')
@@ -43,27 +117,67 @@ class FullVoiceChatBot:
         genai.configure(api_key=self.api_key)
         self.gemini_model = genai.GenerativeModel('gemini-2.0-flash')
 
+        # Initialize local TTS (Piper) if a voice model is configured, else use gTTS
+        self.piper_voice = None
+        piper_model = os.getenv('PIPER_VOICE')
+        if piper_model:
+            if PiperVoice is None:
+                print("⚠️ PIPER_VOICE definido pero piper-tts no está instalado - se usará gTTS")
+            else:
+                print("🗣️ Cargando voz Piper...")
+                self.piper_voice = PiperVoice.load(piper_model)
+
         # Initialize data directory
         self.data_dir = Path("data")
         self.data_dir.mkdir(exist_ok=True)
 
+        # Cache of synthesized (speed-adjusted) answers, keyed by text hash
+        self.tts_cache_dir = self.data_dir / "tts_cache"
+        self.tts_cache_dir.mkdir(exist_ok=True)
+        self.tts_cache_max_files = 200
+
         # Initialize conversation memory
         self.conversation_history = []
         self.max_history_length = 10  # Keep last 10 exchanges
-        self.memory_file = self.data_dir / "memory" / "conversation_memory.json"
+        # Append-only log: one JSON line per exchange, compacted on save_memory()
+        self.memory_file = self.data_dir / "memory" / "conversation_memory.jsonl"
+        self.legacy_memory_file = self.data_dir / "memory" / "conversation_memory.json"
+        self._log_lines = 0  # Lines in the log file since the last compaction
+
+        # Preformatted "Usuario/Asistente" blocks of the last 5 exchanges for the prompt
+        self._ctx_deque = deque(maxlen=5)
 
         # Ensure memory directory exists
         (self.data_dir / "memory").mkdir(parents=True, exist_ok=True)
 
+        # Memory log writes run on a background thread, off the chat loop
+        self._save_q = queue.Queue()
+        threading.Thread(target=self._save_worker, daemon=True).start()
+
         # Load existing conversation history
         self.load_memory()
 
         # Setup signal handler for Ctrl+C
         signal.signal(signal.SIGINT, self.signal_handler)
 
+        # Pay model cold-start costs now rather than on the first utterance
+        self.warm_up_models()
+
         print("✅ Chat por voz completo listo")
         print(f"🧠 Memoria persistente activada: {len(self.conversation_history)}/{self.max_history_length} intercambios cargados")
 
+    def warm_up_models(self):
+        """Run a throwaway TTS inference so the first real turn hits a warm voice"""
+        # The Whisper worker warms its own model before reporting ready
+        if self.piper_voice is None:
+            return
+
+        print("🔥 Precalentando voz...")
+        try:
+            piper_pcm(self.piper_voice, "hola")
+        except Exception as e:
+            print(f"⚠️ Error precalentando voz: {e}")
+
     def signal_handler(self, sig, frame):
         """Handle Ctrl+C gracefully"""
         if self.recording:
@@ -80,13 +194,23 @@ class FullVoiceChatBot:
         print("🎙️ Grabando... Presiona Enter para detener y enviar")
 
         self.recording = True
-        self.audio_data = []
+        self._rec_pos = 0
 
         def audio_callback(indata, frames, time, status):
             if status:
                 print(f"⚠️ Audio status: {status}")
             if self.recording:
-                self.audio_data.append(indata.copy())
+                end = self._rec_pos + frames
+                if end > len(self._rec_buf):
+                    # Out of room: double the buffer, keeping what was recorded
+                    self._rec_buf = np.concatenate((self._rec_buf, np.empty_like(self._rec_buf)))
+                # Copy straight into our buffer, no per-chunk arrays; multi-channel
+                # input is downmixed here so Whisper only ever sees one channel
+                if self.channels == 1:
+                    self._rec_buf[self._rec_pos:end] = indata[:, 0]
+                else:
+                    np.mean(indata, axis=1, out=self._rec_buf[self._rec_pos:end])
+                self._rec_pos = end
 
         try:
             with sd.InputStream(
@@ -104,13 +228,12 @@ class FullVoiceChatBot:
             return None
 
         # Process recorded data
-        if not self.audio_data:
+        if self._rec_pos == 0:
             print("⚠️ No se capturó audio.")
             return None
 
-        # Concatenate all audio data
-        audio_array = np.concatenate(self.audio_data, axis=0)
-        audio_data = audio_array.flatten()
+        # View of the recorded samples (valid until the next recording)
+        audio_data = self._rec_buf[:self._rec_pos]
 
         duration = len(audio_data) / self.sample_rate
         print(f"⏱️ Audio grabado: {duration:.1f}s")
@@ -122,182 +245,271 @@ class FullVoiceChatBot:
         if audio_data is None:
             return None
 
-        # Save audio to temporary file
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-            sf.write(temp_file.name, audio_data, self.sample_rate)
-            temp_path = temp_file.name
+        print("🔄 Transcribiendo...")
+        # The 16 kHz float32 buffer is copied into the worker's shared memory
+        transcription = self.whisper.transcribe(audio_data)
+        return transcription
 
-        try:
-            print("🔄 Transcribiendo...")
-            result = self.whisper_model.transcribe(temp_path, language="es")
-            transcription = result["text"].strip()
-            return transcription
-        finally:
-            # Clean up temporary file
-            os.unlink(temp_path)
-
-    def clean_text_for_speech(self, text):
+    @staticmethod
+    def clean_text_for_speech(text):
         """Clean text from markdown formatting for better TTS"""
-        # Remove markdown formatting
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)  # Bold **text**
-        text = re.sub(r'\*(.*?)\*', r'\1', text)      # Italic *text*
-        text = re.sub(r'`(.*?)`', r'\1', text)        # Code `text`
-        text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)  # Code blocks
-        text = re.sub(r'#{1,6}\s*', '', text)         # Headers
-        text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)  # Links [text](url)
-        text = re.sub(r'^\s*[-*+]\s+', '', text, flags=re.MULTILINE)  # List items
-        text = re.sub(r'^\s*\d+\.\s+', '', text, flags=re.MULTILINE)  # Numbered lists
-        text = re.sub(r'\n{3,}', '\n\n', text)        # Multiple newlines
-        text = re.sub(r'^\s+|\s+$', '', text)         # Leading/trailing whitespace
-
-        return text
+        # Most spoken answers are plain text: skip the substitution entirely
+        if not MARKDOWN_HINT.search(text):
+            return text.strip()
+
+        # Single pass over the text with the precompiled markdown alternation
+        return MARKDOWN_PATTERN.sub(_markdown_replacement, text).strip()
 
     def add_to_conversation_history(self, user_message, assistant_response):
-        """Add exchange to conversation history and save to file"""
-        self.conversation_history.append({
+        """Add exchange to conversation history and append it to the memory log"""
+        entry = {
             "timestamp": datetime.now().isoformat(),
             "user": user_message,
             "assistant": assistant_response
-        })
+        }
+        self.conversation_history.append(entry)
+        self._ctx_deque.append(self.format_exchange(entry))
 
         # Keep only the last N exchanges to avoid token limits
         if len(self.conversation_history) > self.max_history_length:
             self.conversation_history = self.conversation_history[-self.max_history_length:]
 
-        # Save to file after each exchange
-        self.save_memory()
+        # Append just this exchange, written by the background saver
+        self._save_q.put_nowait(entry)
+        self._log_lines += 1
+
+        # Compact the log once it holds well over the history we keep
+        if self._log_lines > 2 * self.max_history_length:
+            self.save_memory(wait=False)
+
+    @staticmethod
+    def format_exchange(exchange):
+        """Format one exchange as it appears in the context prompt"""
+        return f"Usuario: {exchange['user']}\nAsistente: {exchange['assistant']}\n\n"
+
+    def rebuild_context_cache(self):
+        """Refill the prompt context cache from the conversation history"""
+        self._ctx_deque.clear()
+        self._ctx_deque.extend(self.format_exchange(exchange) for exchange in self.conversation_history[-5:])
 
     def build_context_prompt(self, current_message):
         """Build a prompt with conversation context"""
-        if not self.conversation_history:
+        if not self._ctx_deque:
             return current_message
 
-        # Build context from conversation history
-        context = "Contexto de la conversación anterior:\n"
-        for exchange in self.conversation_history[-5:]:  # Use last 5 exchanges for context
-            context += f"Usuario: {exchange['user']}\n"
-            context += f"Asistente: {exchange['assistant']}\n\n"
-
-        # Add current message
-        context += f"Usuario actual: {current_message}\n\n"
-        context += "Responde al usuario actual teniendo en cuenta el contexto de la conversación:"
-
-        return context
+        # Previous exchanges are already formatted; only the current message is new
+        return (
+            "Contexto de la conversación anterior:\n"
+            + "".join(self._ctx_deque)
+            + f"Usuario actual: {current_message}\n\n"
+            + "Responde al usuario actual teniendo en cuenta el contexto de la conversación:"
+        )
 
     def load_memory(self):
-        """Load conversation history from JSON file"""
+        """Load conversation history from the JSONL memory log"""
         try:
             if self.memory_file.exists():
-                with open(self.memory_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.conversation_history = data.get('conversation_history', [])
-                    # Ensure we don't exceed max history length
-                    if len(self.conversation_history) > self.max_history_length:
-                        self.conversation_history = self.conversation_history[-self.max_history_length:]
-                        self.save_memory()  # Save the trimmed history
+                # Only the last N lines matter; deque keeps just those, but
+                # every line counts toward the next compaction
+                lines = deque(maxlen=self.max_history_length)
+                log_lines = 0
+                with open(self.memory_file, 'rb') as f:
+                    for line in f:
+                        if line.strip():
+                            lines.append(line)
+                            log_lines += 1
+                # A torn or corrupt line (e.g. a crash mid-append) costs only
+                # that exchange, not the whole history
+                self.conversation_history = []
+                for line in lines:
+                    try:
+                        self.conversation_history.append(orjson.loads(line))
+                    except orjson.JSONDecodeError:
+                        print(f"⚠️ Línea de memoria inválida omitida: {line[:60]!r}")
+                self._log_lines = log_lines
+            elif self.legacy_memory_file.exists():
+                # Migrate the old single-document JSON memory to the log format
+                data = orjson.loads(self.legacy_memory_file.read_bytes())
+                self.conversation_history = data.get('conversation_history', [])[-self.max_history_length:]
+                self.save_memory()
             else:
                 self.conversation_history = []
         except Exception as e:
             print(f"⚠️ Error cargando memoria: {e}")
             self.conversation_history = []
 
-    def save_memory(self):
-        """Save conversation history to JSON file"""
-        try:
-            memory_data = {
-                "last_updated": datetime.now().isoformat(),
-                "total_exchanges": len(self.conversation_history),
-                "max_history_length": self.max_history_length,
-                "conversation_history": self.conversation_history
-            }
+        self.rebuild_context_cache()
 
-            with open(self.memory_file, 'w', encoding='utf-8') as f:
-                json.dump(memory_data, f, ensure_ascii=False, indent=2)
+    def _save_worker(self):
+        """Background saver: append queued exchanges, compact on history snapshots"""
+        while True:
+            item = self._save_q.get()
+            try:
+                if isinstance(item, list):
+                    self._write_memory(item)
+                else:
+                    with open(self.memory_file, 'ab') as f:
+                        f.write(orjson.dumps(item) + b"\n")
+            except Exception as e:
+                print(f"⚠️ Error guardando memoria: {e}")
+            finally:
+                self._save_q.task_done()
 
-        except Exception as e:
-            print(f"⚠️ Error guardando memoria: {e}")
+    def _write_memory(self, history):
+        """Rewrite the memory log with exactly the given history"""
+        temp_path = self.memory_file.with_suffix('.jsonl.tmp')
+        with open(temp_path, 'wb') as f:
+            f.writelines(orjson.dumps(entry) + b"\n" for entry in history)
+
+        # Atomic swap so a crash never leaves a half-written log
+        os.replace(temp_path, self.memory_file)
+
+    def save_memory(self, wait=True):
+        """Compact the memory log down to the current conversation history"""
+        # The snapshot is queued behind any pending appends, keeping order
+        self._save_q.put(list(self.conversation_history))
+        self._log_lines = len(self.conversation_history)
+
+        if wait:
+            self._save_q.join()
 
     def clear_memory(self):
         """Clear conversation memory"""
         self.conversation_history = []
+        self._ctx_deque.clear()
         self.save_memory()  # Save the cleared memory
         print("🧠 Memoria de conversación borrada y guardada")
 
     def send_to_gemini(self, message):
-        """Send message to Gemini with conversation context"""
+        """Stream Gemini's answer with conversation context, yielding complete sentences"""
         try:
             print("🤖 Gemini está pensando...")
 
             # Build prompt with conversation context
             contextual_prompt = self.build_context_prompt(message)
 
-            response = self.gemini_model.generate_content(contextual_prompt)
-            if response.text:
-                assistant_response = response.text.strip()
+            response = self.gemini_model.generate_content(contextual_prompt, stream=True)
+
+            chunks = []
+            pending = ""
+            for chunk in response:
+                if not chunk.text:
+                    continue
+                chunks.append(chunk.text)
+                pending += chunk.text
+
+                # Everything but the last piece is a finished sentence
+                *sentences, pending = SENTENCE_SPLIT.split(pending)
+                for sentence in sentences:
+                    if sentence.strip():
+                        yield sentence.strip()
+
+            if pending.strip():
+                yield pending.strip()
 
+            assistant_response = "".join(chunks).strip()
+            if assistant_response:
                 # Add this exchange to conversation history
                 self.add_to_conversation_history(message, assistant_response)
-
-                return assistant_response
             else:
-                return "⚠️ No se recibió respuesta"
+                yield "⚠️ No se recibió respuesta"
         except Exception as e:
-            return f"❌ Error: {e}"
+            yield f"❌ Error: {e}"
+
+    def speak_sentences(self, sentence_queue):
+        """Speak queued sentences as they arrive until the turn sentinel"""
+        while True:
+            sentence = sentence_queue.get()
+            if sentence is None:
+                break
+            print(f"🤖 Gemini: {sentence}")
+            self.text_to_speech(sentence)
+
+    def speak_with_piper(self, text, speed=1.25):
+        """Synthesize speech locally with Piper and play the PCM directly"""
+        # length_scale < 1 speeds up speech without the pitch shift of resampling
+        audio = np.frombuffer(piper_pcm(self.piper_voice, text, length_scale=1 / speed), dtype=np.int16)
+
+        print("🔊 Reproduciendo respuesta...")
+        sd.play(audio, samplerate=self.piper_voice.config.sample_rate)
+        sd.wait()
+
+    def play_audio(self, audio):
+        """Play an audio file path, or in-memory MP3 bytes fed over stdin"""
+        if self.audio_player is None:
+            print("❌ No se encontró reproductor de audio")
+            return
+
+        if isinstance(audio, bytes):
+            subprocess.run([self.audio_player, '-'], input=audio, capture_output=True)
+        else:
+            subprocess.run([self.audio_player, str(audio)], capture_output=True)
+
+    def prune_tts_cache(self):
+        """Remove the least recently used cached audio beyond the size limit"""
+        cached = sorted(self.tts_cache_dir.glob("*.mp3"), key=lambda path: path.stat().st_mtime)
+        for path in cached[:-self.tts_cache_max_files]:
+            path.unlink(missing_ok=True)
 
     def text_to_speech(self, text, speed=1.25):
-        """Convert text to speech using gTTS and play at specified speed"""
+        """Convert text to speech (Piper or gTTS) and play at specified speed"""
         try:
             print("🔊 Generando voz...")
 
             # Clean text from markdown formatting
             clean_text = self.clean_text_for_speech(text)
 
-            # Create TTS object with slow=False for more natural speed
-            tts = gTTS(text=clean_text, lang='es', slow=False)
+            # Local synthesis: no network, tempfiles or ffmpeg
+            if self.piper_voice is not None:
+                self.speak_with_piper(clean_text, speed)
+                return
 
-            # Save to temporary file
-            with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_file:
-                original_path = temp_file.name
-                tts.save(original_path)
+            # Repeated answers (goodbye, memory cleared...) are played from cache
+            cache_key = hashlib.blake2b(f"{speed}|{clean_text}".encode(), digest_size=16).hexdigest()
+            cache_path = self.tts_cache_dir / f"{cache_key}.mp3"
+
+            if cache_path.exists():
+                os.utime(cache_path)  # Mark as recently used
+                print("🔊 Reproduciendo respuesta...")
+                self.play_audio(cache_path)
+                return
 
-            # Create speed-adjusted version using ffmpeg
-            speed_adjusted_path = original_path.replace('.mp3', f'_speed{speed}.mp3')
+            # Create TTS object with slow=False for more natural speed
+            tts = gTTS(text=clean_text, lang='es', slow=False)
 
-            print(f"🚀 Ajustando velocidad a {speed}x...")
+            # Keep the MP3 in memory; it only goes through pipes from here on
+            mp3_buffer = io.BytesIO()
+            tts.write_to_fp(mp3_buffer)
+            original_audio = mp3_buffer.getvalue()
 
-            # Use ffmpeg to adjust playback speed
-            ffmpeg_cmd = [
-                'ffmpeg', '-i', original_path,
-                '-filter:a', f'atempo={speed}',
-                '-y',  # Overwrite output file
-                speed_adjusted_path
-            ]
+            if self.ffmpeg_available:
+                print(f"🚀 Ajustando velocidad a {speed}x...")
 
-            result = subprocess.run(ffmpeg_cmd, capture_output=True)
+                # Use ffmpeg to adjust playback speed, reading and writing over pipes
+                ffmpeg_cmd = [
+                    'ffmpeg', '-loglevel', 'quiet',
+                    '-i', 'pipe:0',
+                    '-filter:a', f'atempo={speed}',
+                    '-f', 'mp3', 'pipe:1'
+                ]
 
-            if result.returncode == 0:
-                # Play the speed-adjusted audio
-                print("🔊 Reproduciendo respuesta...")
+                result = subprocess.run(ffmpeg_cmd, input=original_audio, capture_output=True)
 
-                # Try different audio players
-                audio_players = ['mpg123', 'mpv', 'vlc', 'ffplay']
+                if result.returncode == 0 and result.stdout:
+                    # The speed-adjusted audio is written once, straight into the cache
+                    temp_path = cache_path.with_suffix('.tmp')
+                    temp_path.write_bytes(result.stdout)
+                    os.replace(temp_path, cache_path)
+                    self.prune_tts_cache()
 
-                for player in audio_players:
-                    if subprocess.run(['which', player], capture_output=True).returncode == 0:
-                        subprocess.run([player, speed_adjusted_path], capture_output=True)
-                        break
-                else:
-                    print("❌ No se encontró reproductor de audio")
+                    print("🔊 Reproduciendo respuesta...")
+                    self.play_audio(cache_path)
+                    return
 
-                # Clean up speed-adjusted file
-                os.unlink(speed_adjusted_path)
-            else:
                 print("⚠️ No se pudo ajustar velocidad, reproduciendo audio original...")
-                # Fallback to original audio
-                subprocess.run(['mpg123', original_path], capture_output=True)
 
-            # Clean up original file
-            os.unlink(original_path)
+            # Fallback to original audio at normal speed
+            self.play_audio(original_audio)
 
         except Exception as e:
             print(f"❌ Error en text-to-speech: {e}")
@@ -364,12 +576,16 @@ class FullVoiceChatBot:
                     self.save_memory()
                     break
 
-                # Send to Gemini
-                response = self.send_to_gemini(transcription)
-                print(f"🤖 Gemini: {response}")
-
-                # Convert response to speech and play
-                self.text_to_speech(response)
+                # Speak each sentence while Gemini is still streaming the rest
+                sentence_queue = queue.Queue()
+                speaker = threading.Thread(target=self.speak_sentences, args=(sentence_queue,))
+                speaker.start()
+                try:
+                    for sentence in self.send_to_gemini(transcription):
+                        sentence_queue.put(sentence)
+                finally:
+                    sentence_queue.put(None)
+                    speaker.join()
 
             except KeyboardInterrupt:
                 print("\n👋 ¡Hasta luego!")
@@ -377,34 +593,32 @@ class FullVoiceChatBot:
             except Exception as e:
                 print(f"❌ Error inesperado: {e}")
 
+        # The saver is a daemon thread: let it write any queued exchange
+        # before the process exits and kills it
+        self._save_q.join()
+
 
 def check_audio_dependencies():
-    """Check if audio playback dependencies are available"""
+    """Check audio playback dependencies and return the audio player to use"""
     print("🔍 Verificando dependencias de audio...")
 
     # Check ffmpeg for speed adjustment
-    ffmpeg_available = subprocess.run(['which', 'ffmpeg'], capture_output=True).returncode == 0
-    if ffmpeg_available:
+    if shutil.which('ffmpeg'):
         print("✅ FFmpeg disponible para ajuste de velocidad")
     else:
         print("⚠️ FFmpeg no encontrado - se usará velocidad normal")
         print("💡 Instala FFmpeg con: sudo apt install ffmpeg")
 
     # Check audio players
-    audio_players = ['mpg123', 'mpv', 'vlc', 'ffplay']
-    available_players = []
-
-    for player in audio_players:
-        if subprocess.run(['which', player], capture_output=True).returncode == 0:
-            available_players.append(player)
+    available_players = [player for player in AUDIO_PLAYERS if shutil.which(player)]
 
     if available_players:
         print(f"✅ Reproductores disponibles: {', '.join(available_players)}")
-        return True
+        return available_players[0]
     else:
         print("⚠️ No se encontraron reproductores de audio.")
         print("💡 Instala uno con: sudo apt install mpg123")
-        return False
+        return None
 
 
 def main():
@@ -413,12 +627,13 @@ def main():
     print()
 
     # Check dependencies
-    if not check_audio_dependencies():
+    audio_player = check_audio_dependencies()
+    if audio_player is None:
         print("❌ Instala un reproductor de audio antes de continuar.")
         return
 
     try:
-        chat_bot = FullVoiceChatBot()
+        chat_bot = FullVoiceChatBot(audio_player=audio_player)
         chat_bot.start_full_voice_chat()
     except Exception as e:
         print(f"❌ Error al inicializar: {e}")
@@ -2,35 +2,104 @@
 
 import os
 import time
-import tempfile
 import signal
 import sys
+import atexit
 import re
 import json
+import hashlib
+import shutil
+import io
 import asyncio
 from datetime import datetime
 from pathlib import Path
 import subprocess
 
 import sounddevice as sd
-import soundfile as sf
 import numpy as np
-import whisper
 import google.generativeai as genai
 from gtts import gTTS
 from dotenv import load_dotenv
 
+try:
+    from piper.voice import PiperVoice
+except ImportError:
+    PiperVoice = None
+
+try:
+    # piper-tts >= 1.3 takes synthesis options as a SynthesisConfig
+    from piper import SynthesisConfig
+except ImportError:
+    SynthesisConfig = None
+
+
+def piper_pcm(voice, text, length_scale=1.0):
+    """Synthesize text with a Piper voice as raw 16-bit mono PCM bytes"""
+    if SynthesisConfig is not None:
+        # 1.3 replaced synthesize_stream_raw with synthesize(), which yields AudioChunks
+        chunks = voice.synthesize(text, syn_config=SynthesisConfig(length_scale=length_scale))
+        return b"".join(chunk.audio_int16_bytes for chunk in chunks)
+    return b"".join(voice.synthesize_stream_raw(text, length_scale=length_scale))
+
+
+# Whisper runs in a separate worker process
+from asr_worker import WhisperProcess
+
 # Import our advanced memory system
 from memory_system import MemoryManager
 
+# Sentence boundaries used to hand Gemini's streamed answer to TTS early
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+|\n+')
+
+
+# Markdown removed before TTS, fused into one alternation so the text is
+# scanned once; the only capturing group that matched holds the kept text
+MARKDOWN_PATTERN = re.compile(
+    r'^\s*[-*+]\s+'                 # List items
+    r'|^\s*\d+\.\s+'                # Numbered lists
+    r'|(?s:```.*?```)'              # Code blocks
+    r'|\*\*(.+?)\*\*(?!\*)'         # Bold **text**
+    r'|\*(.*?)\*'                   # Italic *text*
+    r'|`(.*?)`'                     # Code `text`
+    r'|#{1,6}\s*'                   # Headers
+    r'|\[([^\]]+)\]\([^\)]+\)'      # Links [text](url)
+    r'|(\n\n)\n+',                  # Multiple newlines
+    re.MULTILINE
+)
+
+
+# Cheap check for any character/line start the pattern above could act on
+MARKDOWN_HINT = re.compile(r'[*`#\[]|^\s*(?:[-+]|\d+\.)\s|\n{3}', re.MULTILINE)
+
+
+def _markdown_replacement(match):
+    """Keep the inner text of a markdown match (cleaned recursively), drop the rest"""
+    if match.lastindex:
+        return MARKDOWN_PATTERN.sub(_markdown_replacement, match.group(match.lastindex))
+    return ''
+
+
+# Audio players tried in order of preference
+AUDIO_PLAYERS = ['mpg123', 'mpv', 'vlc', 'ffplay']
+
 
 class FullVoiceChatBotAdvanced:
-    def __init__(self, sample_rate=16000, channels=1):
+    def __init__(self, sample_rate=16000, channels=1, audio_player=None):
         # Audio settings
         self.sample_rate = sample_rate
         self.channels = channels
+
+        # Player and ffmpeg are resolved once here instead of probed on every answer
+        self.audio_player = audio_player or next(
+            (player for player in AUDIO_PLAYERS if shutil.which(player)), None
+        )
+        self.ffmpeg_available = shutil.which('ffmpeg') is not None
         self.recording = False
-        self.audio_data = []
+
+        # Preallocated mono recording buffer (60 s, grown if needed) written in
+        # place by the audio callback, plus the current write position
+        self._rec_buf = np.empty(60 * sample_rate, dtype=np.float32)
+        self._rec_pos = 0
 
         # Load environment variables
         load_dotenv()
@@ -39,9 +108,16 @@ class FullVoiceChatBotAdvanced:
         self.data_dir = Path("data")
         self.data_dir.mkdir(exist_ok=True)
 
-        # Initialize Whisper for speech-to-text
+        # Cache of synthesized (speed-adjusted) answers, keyed by text hash
+        self.tts_cache_dir = self.data_dir / "tts_cache"
+        self.tts_cache_dir.mkdir(exist_ok=True)
+        self.tts_cache_max_files = 200
+
+        # Initialize Whisper for speech-to-text in its own process, so inference
+        # never competes with audio capture for this process's GIL
         print("🤖 Cargando Whisper...")
-        self.whisper_model = whisper.load_model("base")
+        self.whisper = WhisperProcess()
+        atexit.register(self.whisper.close)
 
         # Initialize Gemini for chat
         self.api_key = os.getenv('API_KEY_GEMINI')
@@ -51,15 +127,41 @@ class FullVoiceChatBotAdvanced:
         genai.configure(api_key=self.api_key)
         self.gemini_model = genai.GenerativeModel('gemini-2.0-flash')
 
+        # Initialize local TTS (Piper) if a voice model is configured, else use gTTS
+        self.piper_voice = None
+        piper_model = os.getenv('PIPER_VOICE')
+        if piper_model:
+            if PiperVoice is None:
+                print("⚠️ PIPER_VOICE definido pero piper-tts no está instalado - se usará gTTS")
+            else:
+                print("🗣️ Cargando voz Piper...")
+                self.piper_voice = PiperVoice.load(piper_model)
+
         # Initialize advanced memory system
         self.memory = MemoryManager()
+        atexit.register(self.memory.close)
         print("🧠 Sistema de memoria avanzado inicializado")
 
         # Setup signal handler for Ctrl+C
         signal.signal(signal.SIGINT, self.signal_handler)
 
+        # Pay model cold-start costs now rather than on the first utterance
+        self.warm_up_models()
+
         print("✅ Chat por voz avanzado listo")
 
+    def warm_up_models(self):
+        """Run a throwaway TTS inference so the first real turn hits a warm voice"""
+        # The Whisper worker warms its own model before reporting ready
+        if self.piper_voice is None:
+            return
+
+        print("🔥 Precalentando voz...")
+        try:
+            piper_pcm(self.piper_voice, "hola")
+        except Exception as e:
+            print(f"⚠️ Error precalentando voz: {e}")
+
     def signal_handler(self, sig, frame):
         """Handle Ctrl+C gracefully"""
         if self.recording:
@@ -74,13 +176,23 @@ class FullVoiceChatBotAdvanced:
         print("🎙️ Grabando... Presiona Enter para detener y enviar")
 
         self.recording = True
-        self.audio_data = []
+        self._rec_pos = 0
 
         def audio_callback(indata, frames, time, status):
             if status:
                 print(f"⚠️ Audio status: {status}")
             if self.recording:
-                self.audio_data.append(indata.copy())
+                end = self._rec_pos + frames
+                if end > len(self._rec_buf):
+                    # Out of room: double the buffer, keeping what was recorded
+                    self._rec_buf = np.concatenate((self._rec_buf, np.empty_like(self._rec_buf)))
+                # Copy straight into our buffer, no per-chunk arrays; multi-channel
+                # input is downmixed here so Whisper only ever sees one channel
+                if self.channels == 1:
+                    self._rec_buf[self._rec_pos:end] = indata[:, 0]
+                else:
+                    np.mean(indata, axis=1, out=self._rec_buf[self._rec_pos:end])
+                self._rec_pos = end
 
         try:
             with sd.InputStream(
@@ -98,13 +210,12 @@ class FullVoiceChatBotAdvanced:
             return None
 
         # Process recorded data
-        if not self.audio_data:
+        if self._rec_pos == 0:
             print("⚠️ No se capturó audio.")
             return None
 
-        # Concatenate all audio data
-        audio_array = np.concatenate(self.audio_data, axis=0)
-        audio_data = audio_array.flatten()
+        # View of the recorded samples (valid until the next recording)
+        audio_data = self._rec_buf[:self._rec_pos]
 
         duration = len(audio_data) / self.sample_rate
         print(f"⏱️ Audio grabado: {duration:.1f}s")
@@ -116,38 +227,46 @@ class FullVoiceChatBotAdvanced:
         if audio_data is None:
             return None
 
-        # Save audio to temporary file
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-            sf.write(temp_file.name, audio_data, self.sample_rate)
-            temp_path = temp_file.name
-
-        try:
-            print("🔄 Transcribiendo...")
-            result = self.whisper_model.transcribe(temp_path, language="es")
-            transcription = result["text"].strip()
-            return transcription
-        finally:
-            # Clean up temporary file
-            os.unlink(temp_path)
+        print("🔄 Transcribiendo...")
+        # The 16 kHz float32 buffer is copied into the worker's shared memory
+        transcription = self.whisper.transcribe(audio_data)
+        return transcription
 
-    def clean_text_for_speech(self, text):
+    @staticmethod
+    def clean_text_for_speech(text):
         """Clean text from markdown formatting for better TTS"""
-        # Remove markdown formatting
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)  # Bold **text**
-        text = re.sub(r'\*(.*?)\*', r'\1', text)      # Italic *text*
-        text = re.sub(r'`(.*?)`', r'\1', text)        # Code `text`
-        text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)  # Code blocks
-        text = re.sub(r'#{1,6}\s*', '', text)         # Headers
-        text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)  # Links [text](url)
-        text = re.sub(r'^\s*[-*+]\s+', '', text, flags=re.MULTILINE)  # List items
-        text = re.sub(r'^\s*\d+\.\s+', '', text, flags=re.MULTILINE)  # Numbered lists
-        text = re.sub(r'\n{3,}', '\n\n', text)        # Multiple newlines
-        text = re.sub(r'^\s+|\s+$', '', text)         # Leading/trailing whitespace
-
-        return text
-
-    async def send_to_gemini(self, message):
-        """Send message to Gemini with advanced context"""
+        # Most spoken answers are plain text: skip the substitution entirely
+        if not MARKDOWN_HINT.search(text):
+            return text.strip()
+
+        # Single pass over the text with the precompiled markdown alternation
+        return MARKDOWN_PATTERN.sub(_markdown_replacement, text).strip()
+
+    def _stream_gemini(self, prompt, loop, sentence_queue):
+        """Stream Gemini's answer, pushing each complete sentence to the TTS queue"""
+        response = self.gemini_model.generate_content(prompt, stream=True)
+
+        chunks = []
+        pending = ""
+        for chunk in response:
+            if not chunk.text:
+                continue
+            chunks.append(chunk.text)
+            pending += chunk.text
+
+            # Everything but the last piece is a finished sentence
+            *sentences, pending = SENTENCE_SPLIT.split(pending)
+            for sentence in sentences:
+                if sentence.strip():
+                    loop.call_soon_threadsafe(sentence_queue.put_nowait, sentence.strip())
+
+        if pending.strip():
+            loop.call_soon_threadsafe(sentence_queue.put_nowait, pending.strip())
+
+        return "".join(chunks).strip()
+
+    async def send_to_gemini(self, message, sentence_queue):
+        """Send message to Gemini with advanced context, streaming sentences to TTS"""
         try:
             print("🤖 Gemini está pensando...")
 
@@ -155,74 +274,123 @@ class FullVoiceChatBotAdvanced:
             contextual_prompt = await self.memory.get_context(message)
             print("🧠 Contexto inteligente cargado")
 
-            response = self.gemini_model.generate_content(contextual_prompt)
-            if response.text:
-                assistant_response = response.text.strip()
-
+            # Blocking stream runs in a worker thread so TTS can start on sentence one
+            loop = asyncio.get_running_loop()
+            assistant_response = await asyncio.to_thread(
+                self._stream_gemini, contextual_prompt, loop, sentence_queue
+            )
+            if assistant_response:
                 # Store this exchange in advanced memory
                 await self.memory.store_conversation(message, assistant_response)
                 print("💾 Conversación almacenada en memoria avanzada")
 
                 return assistant_response
             else:
-                return "⚠️ No se recibió respuesta"
+                response = "⚠️ No se recibió respuesta"
+                await sentence_queue.put(response)
+                return response
         except Exception as e:
-            return f"❌ Error: {e}"
+            response = f"❌ Error: {e}"
+            await sentence_queue.put(response)
+            return response
+        finally:
+            # Sentinel: no more sentences for this turn
+            await sentence_queue.put(None)
+
+    async def speak_sentences(self, sentence_queue):
+        """Speak queued sentences as they arrive until the turn sentinel"""
+        while True:
+            sentence = await sentence_queue.get()
+            if sentence is None:
+                break
+            print(f"🤖 Gemini: {sentence}")
+            await asyncio.to_thread(self.text_to_speech, sentence)
+
+    def speak_with_piper(self, text, speed=1.25):
+        """Synthesize speech locally with Piper and play the PCM directly"""
+        # length_scale < 1 speeds up speech without the pitch shift of resampling
+        audio = np.frombuffer(piper_pcm(self.piper_voice, text, length_scale=1 / speed), dtype=np.int16)
+
+        print("🔊 Reproduciendo respuesta...")
+        sd.play(audio, samplerate=self.piper_voice.config.sample_rate)
+        sd.wait()
+
+    def play_audio(self, audio):
+        """Play an audio file path, or in-memory MP3 bytes fed over stdin"""
+        if self.audio_player is None:
+            print("❌ No se encontró reproductor de audio")
+            return
+
+        if isinstance(audio, bytes):
+            subprocess.run([self.audio_player, '-'], input=audio, capture_output=True)
+        else:
+            subprocess.run([self.audio_player, str(audio)], capture_output=True)
+
+    def prune_tts_cache(self):
+        """Remove the least recently used cached audio beyond the size limit"""
+        cached = sorted(self.tts_cache_dir.glob("*.mp3"), key=lambda path: path.stat().st_mtime)
+        for path in cached[:-self.tts_cache_max_files]:
+            path.unlink(missing_ok=True)
 
     def text_to_speech(self, text, speed=1.25):
-        """Convert text to speech using gTTS and play at specified speed"""
+        """Convert text to speech (Piper or gTTS) and play at specified speed"""
         try:
             print("🔊 Generando voz...")
 
             # Clean text from markdown formatting
             clean_text = self.clean_text_for_speech(text)
 
-            # Create TTS object with slow=False for more natural speed
-            tts = gTTS(text=clean_text, lang='es', slow=False)
+            # Local synthesis: no network, tempfiles or ffmpeg
+            if self.piper_voice is not None:
+                self.speak_with_piper(clean_text, speed)
+                return
 
-            # Save to temporary file
-            with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_file:
-                original_path = temp_file.name
-                tts.save(original_path)
+            # Repeated answers (goodbye, memory cleared...) are played from cache
+            cache_key = hashlib.blake2b(f"{speed}|{clean_text}".encode(), digest_size=16).hexdigest()
+            cache_path = self.tts_cache_dir / f"{cache_key}.mp3"
 
-            # Create speed-adjusted version using ffmpeg
-            speed_adjusted_path = original_path.replace('.mp3', f'_speed{speed}.mp3')
+            if cache_path.exists():
+                os.utime(cache_path)  # Mark as recently used
+                print("🔊 Reproduciendo respuesta...")
+                self.play_audio(cache_path)
+                return
 
-            print(f"🚀 Ajustando velocidad a {speed}x...")
+            # Create TTS object with slow=False for more natural speed
+            tts = gTTS(text=clean_text, lang='es', slow=False)
 
-            # Use ffmpeg to adjust playback speed
-            ffmpeg_cmd = [
-                'ffmpeg', '-i', original_path,
-                '-filter:a', f'atempo={speed}',
-                '-y',  # Overwrite output file
-                speed_adjusted_path
-            ]
+            # Keep the MP3 in memory; it only goes through pipes from here on
+            mp3_buffer = io.BytesIO()
+            tts.write_to_fp(mp3_buffer)
+            original_audio = mp3_buffer.getvalue()
 
-            result = subprocess.run(ffmpeg_cmd, capture_output=True)
+            if self.ffmpeg_available:
+                print(f"🚀 Ajustando velocidad a {speed}x...")
 
-            if result.returncode == 0:
-                # Play the speed-adjusted audio
-                print("🔊 Reproduciendo respuesta...")
+                # Use ffmpeg to adjust playback speed, reading and writing over pipes
+                ffmpeg_cmd = [
+                    'ffmpeg', '-loglevel', 'quiet',
+                    '-i', 'pipe:0',
+                    '-filter:a', f'atempo={speed}',
+                    '-f', 'mp3', 'pipe:1'
+                ]
 
-                # Try different audio players
-                audio_players = ['mpg123', 'mpv', 'vlc', 'ffplay']
+                result = subprocess.run(ffmpeg_cmd, input=original_audio, capture_output=True)
 
-                for player in audio_players:
-                    if subprocess.run(['which', player], capture_output=True).returncode == 0:
-                        subprocess.run([player, speed_adjusted_path], capture_output=True)
-                        break
-                else:
-                    print("❌ No se encontró reproductor de audio")
+                if result.returncode == 0 and result.stdout:
+                    # The speed-adjusted audio is written once, straight into the cache
+                    temp_path = cache_path.with_suffix('.tmp')
+                    temp_path.write_bytes(result.stdout)
+                    os.replace(temp_path, cache_path)
+                    self.prune_tts_cache()
+
+                    print("🔊 Reproduciendo respuesta...")
+                    self.play_audio(cache_path)
+                    return
 
-                # Clean up speed-adjusted file
-                os.unlink(speed_adjusted_path)
-            else:
                 print("⚠️ No se pudo ajustar velocidad, reproduciendo audio original...")
-                # Fallback to original audio
-                subprocess.run(['mpg123', original_path], capture_output=True)
 
-            # Clean up original file
-            os.unlink(original_path)
+            # Fallback to original audio at normal speed
+            self.play_audio(original_audio)
 
         except Exception as e:
             print(f"❌ Error en text-to-speech: {e}")
@@ -309,12 +477,13 @@ class FullVoiceChatBotAdvanced:
                     self.text_to_speech(goodbye_response)
                     break
 
-                # Send to Gemini with advanced memory
-                response = await self.send_to_gemini(transcription)
-                print(f"🤖 Gemini: {response}")
-
-                # Convert response to speech and play
-                self.text_to_speech(response)
+                # Send to Gemini with advanced memory, speaking each sentence
+                # while the rest of the answer is still streaming in
+                sentence_queue = asyncio.Queue()
+                await asyncio.gather(
+                    self.send_to_gemini(transcription, sentence_queue),
+                    self.speak_sentences(sentence_queue)
+                )
 
             except KeyboardInterrupt:
                 print("\n👋 ¡Hasta luego!")
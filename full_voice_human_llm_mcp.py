@@ -2,28 +2,71 @@
 
 import os
 import time
-import tempfile
+import atexit
 import signal
 import sys
 import re
 import json
 import asyncio
+import hashlib
+import io
+import shutil
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
 import subprocess
 
 import sounddevice as sd
-import soundfile as sf
 import numpy as np
-import whisper
 import google.generativeai as genai
 from gtts import gTTS
 from dotenv import load_dotenv
 
+try:
+    from piper.voice import PiperVoice
+except ImportError:
+    PiperVoice = None
+
+try:
+    # piper-tts >= 1.3 takes synthesis options as a SynthesisConfig
+    from piper import SynthesisConfig
+except ImportError:
+    SynthesisConfig = None
+
+
+def piper_pcm(voice, text, length_scale=1.0):
+    """Synthesize text with a Piper voice as raw 16-bit mono PCM bytes"""
+    if SynthesisConfig is not None:
+        # 1.3 replaced synthesize_stream_raw with synthesize(), which yields AudioChunks
+        chunks = voice.synthesize(text, syn_config=SynthesisConfig(length_scale=length_scale))
+        return b"".join(chunk.audio_int16_bytes for chunk in chunks)
+    return b"".join(voice.synthesize_stream_raw(text, length_scale=length_scale))
+
+
+# Whisper runs in a separate worker process
+from asr_worker import WhisperProcess
+
 # MCP imports
 from mcp.client import Client
 from mcp.types import CallToolRequest
 
+# Markdown removed before TTS, compiled once at import instead of per response
+_RX_BOLD = re.compile(r'\*\*(.*?)\*\*')                  # Bold **text**
+_RX_ITAL = re.compile(r'\*(.*?)\*')                      # Italic *text*
+_RX_CODE = re.compile(r'`(.*?)`')                        # Code `text`
+_RX_CBLOCK = re.compile(r'```.*?```', re.DOTALL)         # Code blocks
+_RX_HDR = re.compile(r'#{1,6}\s*')                       # Headers
+_RX_LINK = re.compile(r'\[([^\]]+)\]\([^\)]+\)')         # Links [text](url)
+_RX_BULLET = re.compile(r'^\s*[-*+]\s+', re.MULTILINE)   # List items
+_RX_NUM = re.compile(r'^\s*\d+\.\s+', re.MULTILINE)      # Numbered lists
+_RX_NL = re.compile(r'\n{3,}')                           # Multiple newlines
+
+# Sentence boundaries used to hand Gemini's streamed answer to TTS early
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+|\n+')
+
+# Audio players tried in order of preference
+AUDIO_PLAYERS = ['mpg123', 'mpv', 'vlc', 'ffplay']
+
 
 class FullVoiceChatBotMCP:
     def __init__(self, sample_rate=16000, channels=1):
@@ -31,7 +74,21 @@ class FullVoiceChatBotMCP:
         self.sample_rate = sample_rate
         self.channels = channels
         self.recording = False
-        self.audio_data = []
+
+        # Player (only needed when ffmpeg can't decode gTTS output) and ffmpeg
+        # are resolved once here instead of probed on every answer
+        self.audio_player = next((player for player in AUDIO_PLAYERS if shutil.which(player)), None)
+        self.ffmpeg_available = shutil.which('ffmpeg') is not None
+        if not self.ffmpeg_available:
+            print("⚠️ FFmpeg no encontrado - se usará velocidad normal")
+            if self.audio_player is None:
+                print("⚠️ No se encontraron reproductores de audio.")
+                print("💡 Instala uno con: sudo apt install mpg123")
+
+        # Preallocated mono recording buffer (60 s, grown if needed) written in
+        # place by the audio callback, plus the current write position
+        self._rec_buf = np.empty(60 * sample_rate, dtype=np.float32)
+        self._rec_pos = 0
 
         # Load environment variables
         load_dotenv()
@@ -40,9 +97,11 @@ class FullVoiceChatBotMCP:
         self.data_dir = Path("data")
         self.data_dir.mkdir(exist_ok=True)
 
-        # Initialize Whisper for speech-to-text
+        # Initialize Whisper for speech-to-text in its own long-lived process, so
+        # the model stays resident and is released deterministically on exit
         print("🤖 Cargando Whisper...")
-        self.whisper_model = whisper.load_model("base")
+        self.whisper = WhisperProcess()
+        atexit.register(self.whisper.close)
 
         # Initialize Gemini for chat
         self.api_key = os.getenv('API_KEY_GEMINI')
@@ -51,11 +110,31 @@ class FullVoiceChatBotMCP:
 
         genai.configure(api_key=self.api_key)
         self.gemini_model = genai.GenerativeModel('gemini-2.0-flash')
+        # Hash of the memory context currently set as system instruction
+        self._system_context_hash = None
+
+        # Initialize local TTS (Piper) if a voice model is configured, else use gTTS
+        self.piper_voice = None
+        piper_model = os.getenv('PIPER_VOICE')
+        if piper_model:
+            if PiperVoice is None:
+                print("⚠️ PIPER_VOICE definido pero piper-tts no está instalado - se usará gTTS")
+            else:
+                print("🗣️ Cargando voz Piper...")
+                self.piper_voice = PiperVoice.load(piper_model)
+
+        # Decoded, speed-adjusted PCM of recent answers keyed by text hash, so
+        # repeated phrases (goodbye, memory cleared...) play without synthesis
+        self._tts_cache = OrderedDict()
+        self.tts_cache_max_entries = 64
 
         # Initialize MCP client
         self.mcp_client = None
         self.memory_available = False
 
+        # Fire-and-forget MCP writes, referenced here until they finish
+        self._background_tasks = set()
+
         # Setup signal handler for Ctrl+C
         signal.signal(signal.SIGINT, self.signal_handler)
 
@@ -89,13 +168,23 @@ class FullVoiceChatBotMCP:
         print("🎙️ Grabando... Presiona Enter para detener y enviar")
 
         self.recording = True
-        self.audio_data = []
+        self._rec_pos = 0
 
         def audio_callback(indata, frames, time, status):
             if status:
                 print(f"⚠️ Audio status: {status}")
             if self.recording:
-                self.audio_data.append(indata.copy())
+                end = self._rec_pos + frames
+                if end > len(self._rec_buf):
+                    # Out of room: double the buffer, keeping what was recorded
+                    self._rec_buf = np.concatenate((self._rec_buf, np.empty_like(self._rec_buf)))
+                # Copy straight into our buffer, no per-chunk arrays; multi-channel
+                # input is downmixed here so Whisper only ever sees one channel
+                if self.channels == 1:
+                    self._rec_buf[self._rec_pos:end] = indata[:, 0]
+                else:
+                    np.mean(indata, axis=1, out=self._rec_buf[self._rec_pos:end])
+                self._rec_pos = end
 
         try:
             with sd.InputStream(
@@ -113,13 +202,12 @@ class FullVoiceChatBotMCP:
             return None
 
         # Process recorded data
-        if not self.audio_data:
+        if self._rec_pos == 0:
             print("⚠️ No se capturó audio.")
             return None
 
-        # Concatenate all audio data
-        audio_array = np.concatenate(self.audio_data, axis=0)
-        audio_data = audio_array.flatten()
+        # View of the recorded samples (valid until the next recording)
+        audio_data = self._rec_buf[:self._rec_pos]
 
         duration = len(audio_data) / self.sample_rate
         print(f"⏱️ Audio grabado: {duration:.1f}s")
@@ -131,35 +219,27 @@ class FullVoiceChatBotMCP:
         if audio_data is None:
             return None
 
-        # Save audio to temporary file
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-            sf.write(temp_file.name, audio_data, self.sample_rate)
-            temp_path = temp_file.name
-
-        try:
-            print("🔄 Transcribiendo...")
-            result = self.whisper_model.transcribe(temp_path, language="es")
-            transcription = result["text"].strip()
-            return transcription
-        finally:
-            # Clean up temporary file
-            os.unlink(temp_path)
+        print("🔄 Transcribiendo...")
+        # Partial segments are shown as the worker decodes them
+        return self.whisper.transcribe(
+            audio_data,
+            on_segment=lambda text: print(f"   📝 {text}")
+        )
 
     def clean_text_for_speech(self, text):
         """Clean text from markdown formatting for better TTS"""
         # Remove markdown formatting
-        text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)  # Bold **text**
-        text = re.sub(r'\*(.*?)\*', r'\1', text)      # Italic *text*
-        text = re.sub(r'`(.*?)`', r'\1', text)        # Code `text`
-        text = re.sub(r'```.*?```', '', text, flags=re.DOTALL)  # Code blocks
-        text = re.sub(r'#{1,6}\s*', '', text)         # Headers
-        text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)  # Links [text](url)
-        text = re.sub(r'^\s*[-*+]\s+', '', text, flags=re.MULTILINE)  # List items
-        text = re.sub(r'^\s*\d+\.\s+', '', text, flags=re.MULTILINE)  # Numbered lists
-        text = re.sub(r'\n{3,}', '\n\n', text)        # Multiple newlines
-        text = re.sub(r'^\s+|\s+$', '', text)         # Leading/trailing whitespace
-
-        return text
+        text = _RX_BOLD.sub(r'\1', text)
+        text = _RX_ITAL.sub(r'\1', text)
+        text = _RX_CODE.sub(r'\1', text)
+        text = _RX_CBLOCK.sub('', text)
+        text = _RX_HDR.sub('', text)
+        text = _RX_LINK.sub(r'\1', text)
+        text = _RX_BULLET.sub('', text)
+        text = _RX_NUM.sub('', text)
+        text = _RX_NL.sub('\n\n', text)
+
+        return text.strip()
 
     async def store_conversation_mcp(self, user_message, assistant_response):
         """Store conversation using MCP"""
@@ -200,16 +280,31 @@ class FullVoiceChatBotMCP:
 
             result = await self.mcp_client.call_tool(request)
 
-            if result.content and len(result.content) > 0:
-                context_text = result.content[0].text
+            # Stable context (profile + recent turns), then the per-message prompt
+            if result.content and len(result.content) > 1:
+                self.set_system_context(result.content[0].text)
                 print("🧠 Contexto cargado desde memoria MCP")
-                return context_text
+                return result.content[1].text
 
         except Exception as e:
             print(f"⚠️ Error obteniendo contexto MCP: {e}")
 
         return current_message
 
+    def set_system_context(self, stable_context):
+        """Use the stable memory context as Gemini's system instruction"""
+        # Only rebuild the model when the context changed, so consecutive
+        # requests share the same prompt prefix
+        context_hash = hashlib.blake2b(stable_context.encode(), digest_size=16).digest()
+        if context_hash == self._system_context_hash:
+            return
+
+        self.gemini_model = genai.GenerativeModel(
+            'gemini-2.0-flash',
+            system_instruction=stable_context or None
+        )
+        self._system_context_hash = context_hash
+
     async def clear_memory_mcp(self):
         """Clear memory using MCP"""
         if not self.memory_available or not self.mcp_client:
@@ -228,81 +323,188 @@ class FullVoiceChatBotMCP:
         except Exception as e:
             print(f"⚠️ Error borrando memoria MCP: {e}")
 
-    async def send_to_gemini(self, message):
-        """Send message to Gemini with MCP context"""
+    def _stream_gemini(self, prompt, loop, sentence_queue):
+        """Stream Gemini's answer, pushing each complete sentence to the TTS queue"""
+        response = self.gemini_model.generate_content(prompt, stream=True)
+
+        chunks = []
+        pending = ""
+        for chunk in response:
+            if not chunk.text:
+                continue
+            chunks.append(chunk.text)
+            pending += chunk.text
+
+            # Everything but the last piece is a finished sentence
+            *sentences, pending = SENTENCE_SPLIT.split(pending)
+            for sentence in sentences:
+                if sentence.strip():
+                    loop.call_soon_threadsafe(sentence_queue.put_nowait, sentence.strip())
+
+        if pending.strip():
+            loop.call_soon_threadsafe(sentence_queue.put_nowait, pending.strip())
+
+        return "".join(chunks).strip()
+
+    async def send_to_gemini(self, message, sentence_queue):
+        """Send message to Gemini with MCP context, streaming sentences to TTS"""
         try:
             print("🤖 Gemini está pensando...")
 
             # Get context from MCP
             contextual_prompt = await self.get_context_mcp(message)
 
-            response = self.gemini_model.generate_content(contextual_prompt)
-            if response.text:
-                assistant_response = response.text.strip()
-
-                # Store this exchange in MCP
-                await self.store_conversation_mcp(message, assistant_response)
+            # Blocking stream runs in a worker thread so TTS can start on sentence one
+            loop = asyncio.get_running_loop()
+            assistant_response = await asyncio.to_thread(
+                self._stream_gemini, contextual_prompt, loop, sentence_queue
+            )
+            if assistant_response:
+                # Store this exchange in MCP without holding up the answer
+                task = asyncio.create_task(self.store_conversation_mcp(message, assistant_response))
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
 
                 return assistant_response
             else:
-                return "⚠️ No se recibió respuesta"
+                response = "⚠️ No se recibió respuesta"
+                await sentence_queue.put(response)
+                return response
         except Exception as e:
-            return f"❌ Error: {e}"
+            response = f"❌ Error: {e}"
+            await sentence_queue.put(response)
+            return response
+        finally:
+            # Sentinel: no more sentences for this turn
+            await sentence_queue.put(None)
 
-    def text_to_speech(self, text, speed=1.25):
-        """Convert text to speech using gTTS and play at specified speed"""
+    async def synthesize_sentences(self, sentence_queue, audio_queue):
+        """Synthesize queued sentences as they arrive, handing the audio to the player"""
         try:
-            print("🔊 Generando voz...")
+            while True:
+                sentence = await sentence_queue.get()
+                if sentence is None:
+                    break
+                try:
+                    audio = await asyncio.to_thread(self.synthesize, sentence)
+                except Exception as e:
+                    print(f"❌ Error en text-to-speech: {e}")
+                    audio = None
+                # Queue the sentence even without audio so it is still shown
+                await audio_queue.put((sentence, audio))
+        finally:
+            await audio_queue.put(None)
 
-            # Clean text from markdown formatting
-            clean_text = self.clean_text_for_speech(text)
+    async def play_sentences(self, audio_queue):
+        """Play synthesized sentences in order while the next ones are synthesized"""
+        while True:
+            item = await audio_queue.get()
+            if item is None:
+                break
+            sentence, audio = item
+            print(f"🤖 Gemini: {sentence}")
+            if audio is not None:
+                await asyncio.to_thread(self.play_audio, audio)
+
+    def synthesize_with_piper(self, text, speed=1.25):
+        """Synthesize speech locally with Piper, returning 16-bit PCM and its rate"""
+        # length_scale < 1 speeds up speech without the pitch shift of resampling
+        audio = np.frombuffer(piper_pcm(self.piper_voice, text, length_scale=1 / speed), dtype=np.int16)
+        return audio, self.piper_voice.config.sample_rate
+
+    def synthesize_with_gtts(self, text, speed=1.25):
+        """Synthesize speech with gTTS and decode it, speed-adjusted, to 16-bit PCM
+
+        Without a working ffmpeg the original MP3 bytes are returned instead.
+        """
+        # Create TTS object with slow=False for more natural speed
+        tts = gTTS(text=text, lang='es', slow=False)
+
+        # Keep the MP3 in memory; it is piped to ffmpeg (or the player) on stdin
+        mp3_buffer = io.BytesIO()
+        tts.write_to_fp(mp3_buffer)
+        original_audio = mp3_buffer.getvalue()
+
+        if not self.ffmpeg_available:
+            return original_audio
+
+        print(f"🚀 Ajustando velocidad a {speed}x...")
+
+        # Use ffmpeg to adjust playback speed and decode to raw mono PCM
+        # (gTTS audio is 24 kHz) on stdout, ready for sounddevice
+        ffmpeg_cmd = [
+            'ffmpeg', '-loglevel', 'quiet', '-i', 'pipe:0',
+            '-filter:a', f'atempo={speed}',
+            '-f', 's16le', '-ac', '1', '-ar', '24000',
+            'pipe:1'
+        ]
+
+        result = subprocess.run(ffmpeg_cmd, input=original_audio, capture_output=True)
+
+        if result.returncode == 0:
+            return np.frombuffer(result.stdout, dtype=np.int16), 24000
+
+        print("⚠️ No se pudo ajustar velocidad, reproduciendo audio original...")
+        # Fallback to original audio
+        return original_audio
+
+    def play_mp3(self, audio):
+        """Play in-memory MP3 bytes with the audio player resolved at startup"""
+        if self.audio_player is None:
+            print("❌ No se encontró reproductor de audio")
+            return
 
-            # Create TTS object with slow=False for more natural speed
-            tts = gTTS(text=clean_text, lang='es', slow=False)
+        print("🔊 Reproduciendo respuesta...")
+        # All supported players read the stream from stdin when given '-'
+        subprocess.run([self.audio_player, '-'], input=audio, capture_output=True, check=False)
 
-            # Save to temporary file
-            with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as temp_file:
-                original_path = temp_file.name
-                tts.save(original_path)
+    def play_pcm(self, audio, sample_rate):
+        """Play 16-bit PCM through sounddevice"""
+        print("🔊 Reproduciendo respuesta...")
+        sd.play(audio, samplerate=sample_rate)
+        sd.wait()
 
-            # Create speed-adjusted version using ffmpeg
-            speed_adjusted_path = original_path.replace('.mp3', f'_speed{speed}.mp3')
+    def play_audio(self, audio):
+        """Play what synthesize() returned: (PCM, sample_rate) or MP3 bytes"""
+        if isinstance(audio, bytes):
+            self.play_mp3(audio)
+        else:
+            self.play_pcm(*audio)
 
-            print(f"🚀 Ajustando velocidad a {speed}x...")
+    def synthesize(self, text, speed=1.25):
+        """Convert text to speed-adjusted PCM (cache, Piper or gTTS)
 
-            # Use ffmpeg to adjust playback speed
-            ffmpeg_cmd = [
-                'ffmpeg', '-i', original_path,
-                '-filter:a', f'atempo={speed}',
-                '-y',  # Overwrite output file
-                speed_adjusted_path
-            ]
+        Returns (audio, sample_rate), or the original MP3 bytes when gTTS
+        audio can't be decoded with ffmpeg.
+        """
+        print("🔊 Generando voz...")
 
-            result = subprocess.run(ffmpeg_cmd, capture_output=True)
+        # Clean text from markdown formatting
+        clean_text = self.clean_text_for_speech(text)
 
-            if result.returncode == 0:
-                # Play the speed-adjusted audio
-                print("🔊 Reproduciendo respuesta...")
+        # Repeated phrases come straight from the cache
+        cache_key = hashlib.blake2b(f"{speed}|{clean_text}".encode(), digest_size=16).digest()
+        cached = self._tts_cache.get(cache_key)
+        if cached is not None:
+            self._tts_cache.move_to_end(cache_key)
+            return cached
 
-                # Try different audio players
-                audio_players = ['mpg123', 'mpv', 'vlc', 'ffplay']
+        # Local synthesis (no network, tempfiles or ffmpeg) when available
+        if self.piper_voice is not None:
+            synthesized = self.synthesize_with_piper(clean_text, speed)
+        else:
+            synthesized = self.synthesize_with_gtts(clean_text, speed)
 
-                for player in audio_players:
-                    if subprocess.run(['which', player], capture_output=True).returncode == 0:
-                        subprocess.run([player, speed_adjusted_path], capture_output=True)
-                        break
-                else:
-                    print("❌ No se encontró reproductor de audio")
+        self._tts_cache[cache_key] = synthesized
+        if len(self._tts_cache) > self.tts_cache_max_entries:
+            self._tts_cache.popitem(last=False)  # Least recently used
 
-                # Clean up speed-adjusted file
-                os.unlink(speed_adjusted_path)
-            else:
-                print("⚠️ No se pudo ajustar velocidad, reproduciendo audio original...")
-                # Fallback to original audio
-                subprocess.run(['mpg123', original_path], capture_output=True)
+        return synthesized
 
-            # Clean up original file
-            os.unlink(original_path)
+    def text_to_speech(self, text, speed=1.25):
+        """Convert text to speech (Piper or gTTS) and play at specified speed"""
+        try:
+            self.play_audio(self.synthesize(text, speed))
 
         except Exception as e:
             print(f"❌ Error en text-to-speech: {e}")
@@ -355,7 +557,7 @@ class FullVoiceChatBotMCP:
                     await self.clear_memory_mcp()
                     response = "He borrado la memoria de nuestra conversación. Empezamos de nuevo."
                     print(f"🤖 Gemini: {response}")
-                    self.text_to_speech(response)
+                    await asyncio.to_thread(self.text_to_speech, response)
                     continue
 
                 # Check if user wants to exit
@@ -365,15 +567,18 @@ class FullVoiceChatBotMCP:
                     # Say goodbye with voice
                     goodbye_response = "¡Hasta luego! Ha sido un placer hablar contigo."
                     print(f"🤖 Gemini: {goodbye_response}")
-                    self.text_to_speech(goodbye_response)
+                    await asyncio.to_thread(self.text_to_speech, goodbye_response)
                     break
 
-                # Send to Gemini with MCP context
-                response = await self.send_to_gemini(transcription)
-                print(f"🤖 Gemini: {response}")
-
-                # Convert response to speech and play
-                self.text_to_speech(response)
+                # Send to Gemini with MCP context as a three-stage pipeline:
+                # streamed sentences are synthesized while the previous one plays
+                sentence_queue = asyncio.Queue()
+                audio_queue = asyncio.Queue()
+                await asyncio.gather(
+                    self.send_to_gemini(transcription, sentence_queue),
+                    self.synthesize_sentences(sentence_queue, audio_queue),
+                    self.play_sentences(audio_queue)
+                )
 
             except KeyboardInterrupt:
                 print("\n👋 ¡Hasta luego!")
@@ -381,6 +586,10 @@ class FullVoiceChatBotMCP:
             except Exception as e:
                 print(f"❌ Error inesperado: {e}")
 
+        # Let pending memory writes finish before the event loop closes
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+
 
 async def main():
     """Main function"""
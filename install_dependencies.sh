@@ -1,25 +1,22 @@
 #!/bin/bash
 
-echo "Instalando dependencias del sistema para el grabador de audio..."
+echo "Instalando dependencias del sistema para el chat de voz..."
 
 # Instalar PortAudio development package
-echo "Instalando PortAudio..."
+echo "Instalando PortAudio, ffmpeg y mpg123..."
 sudo apt update
-sudo apt install -y portaudio19-dev
+sudo apt install -y portaudio19-dev ffmpeg mpg123
 
 # Activar entorno virtual e instalar dependencias Python
 echo "Activando entorno virtual e instalando dependencias Python..."
 source env/bin/activate
 pip install --upgrade pip
 
-# Instalar dependencias básicas
-pip install sounddevice soundfile numpy
+# Instalar dependencias del proyecto (faster-whisper, orjson, gtts, mcp...)
+pip install -r requirements.txt
 
 echo "Instalación completada!"
 echo ""
-echo "Para usar el grabador:"
+echo "Para usar el chat de voz:"
 echo "1. Ejecuta: source env/bin/activate"
-echo "2. Ejecuta: python grabador_simple.py"
-echo ""
-echo "Para instalar Whisper (transcripción automática):"
-echo "pip install openai-whisper"
\ No newline at end of file
+echo "2. Ejecuta: python full_voice_human_llm_advanced.py"
\ No newline at end of file
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""Database schema and full-text search shared by memory_server.py and memory_system.py
+
+Both modules open the same SQLite file, so they create its tables, FTS5
+index and triggers from one definition, stamp rows in the same format and
+build their FTS5 MATCH expressions the same way.
+"""
+
+import re
+import sqlite3
+import time
+import unicodedata
+from typing import Optional
+
+# Words of a search query, each passed to FTS5 as a quoted prefix term
+FTS_TOKEN = re.compile(r"\w+")
+
+# Words left out of searches (accent-free, as normalize_query produces them):
+# they appear in nearly every row, so as OR'ed prefix terms they would match
+# the whole table without helping BM25 rank anything. Single characters are
+# dropped as well
+SEARCH_STOPWORDS = frozenset("""
+    a al algo como con de del e el ella ellos en era es esa ese eso esta este
+    esto fue ha hay la las le les lo los me mi mis muy mas nos o para pero por
+    que se ser si sin son su sus te tu tus un una uno unos unas y ya yo
+""".split())
+
+
+def current_timestamp() -> str:
+    """Local time as an ISO-8601 string with second resolution, for row timestamps"""
+    # Rows are ordered by id, so sub-second precision buys nothing; one
+    # strftime call is cheaper than building and formatting a datetime
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def init_schema(conn: sqlite3.Connection):
+    """Create the memory tables, indexes and full-text index if missing"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            session_id TEXT,
+            user_message TEXT NOT NULL,
+            assistant_response TEXT NOT NULL,
+            context_summary TEXT,
+            importance_score REAL DEFAULT 1.0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Full-text index over the conversations table (external content,
+    # kept in sync by triggers) so searches don't scan every row
+    fts_exists = conn.execute(
+        "SELECT sql LIKE '%prefix=%' FROM sqlite_master WHERE type = 'table' AND name = 'conversations_fts'"
+    ).fetchone()
+    if fts_exists and not fts_exists[0]:
+        # Created before the prefix indexes were added; rebuild it
+        conn.execute("DROP TABLE conversations_fts")
+        fts_exists = None
+
+    # prefix='2 3' keeps 2- and 3-character prefix indexes, so short
+    # "tok"* queries are a single lookup instead of a term-range scan
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            user_message,
+            assistant_response,
+            content='conversations',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_ai AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts (rowid, user_message, assistant_response)
+            VALUES (new.id, new.user_message, new.assistant_response);
+        END
+    ''')
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_ad AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts (conversations_fts, rowid, user_message, assistant_response)
+            VALUES ('delete', old.id, old.user_message, old.assistant_response);
+        END
+    ''')
+
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_au AFTER UPDATE ON conversations BEGIN
+            INSERT INTO conversations_fts (conversations_fts, rowid, user_message, assistant_response)
+            VALUES ('delete', old.id, old.user_message, old.assistant_response);
+            INSERT INTO conversations_fts (rowid, user_message, assistant_response)
+            VALUES (new.id, new.user_message, new.assistant_response);
+        END
+    ''')
+
+    if not fts_exists:
+        # Index conversations stored before the FTS table existed
+        conn.execute("INSERT INTO conversations_fts (conversations_fts) VALUES ('rebuild')")
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS memory_summaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            summary_text TEXT NOT NULL,
+            start_timestamp TEXT,
+            end_timestamp TEXT,
+            conversation_count INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_profile (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            last_updated TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Recent-N per session and importance-ordered reads without a full sort
+    conn.execute("DROP INDEX IF EXISTS idx_conv_session_ts")  # Replaced by idx_conv_session_id
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conv_session_id
+        ON conversations(session_id, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conv_importance
+        ON conversations(importance_score DESC, timestamp DESC)
+    ''')
+
+
+def normalize_query(text: str) -> str:
+    """Case-fold a search query and strip its accents ("Años" -> "anos")"""
+    # NFKD splits accented letters into base + combining mark; the marks are
+    # not \w, so left in place they would cut "años" into two FTS terms
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+
+def fts_match_query(query: str, skip_stopwords: bool = True) -> Optional[str]:
+    """Build an FTS5 MATCH expression from free text, or None if it has no words"""
+    # Quote every word (so FTS5 syntax in the query is literal) and match
+    # it as a prefix; any word may match, BM25 ranks rows with more/rarer ones
+    tokens = FTS_TOKEN.findall(normalize_query(query))
+    if skip_stopwords:
+        tokens = [token for token in tokens if len(token) > 1 and token not in SEARCH_STOPWORDS]
+    if not tokens:
+        return None
+    return " OR ".join(f'"{token}"*' for token in tokens)
@@ -2,13 +2,15 @@
 
 import asyncio
 import json
+import re
 import sqlite3
-import numpy as np
+import threading
+from collections import deque
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 import logging
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, contextmanager
 
 from mcp.server import Server
 from mcp.types import (
@@ -20,82 +22,95 @@ from mcp.types import (
     ListToolsResult,
 )
 
+from memory_search import current_timestamp, fts_match_query, init_schema
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+# Maximum characters of profile + past exchanges sent along with a message
+CONTEXT_CHAR_BUDGET = 3000
+
 class MemoryDatabase:
+    # Write statements kept as constants so the connection's statement cache
+    # reuses the compiled versions instead of re-parsing them on every call
+    STORE_CONVERSATION_SQL = '''
+        INSERT INTO conversations
+        (timestamp, session_id, user_message, assistant_response, importance_score)
+        VALUES (?, ?, ?, ?, ?)
+    '''
+    UPDATE_PROFILE_SQL = '''
+        INSERT OR REPLACE INTO user_profile (key, value, last_updated)
+        VALUES (?, ?, ?)
+    '''
+
     def __init__(self, db_path: str = "data/memory/conversation.db"):
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # One connection for the lifetime of the database object (autocommit,
+        # WAL so readers don't block the writer)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+
+        # Calls arrive from asyncio.to_thread workers; one method at a time
+        self._lock = threading.Lock()
+
         self.init_database()
 
     def init_database(self):
         """Initialize SQLite database with required tables"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp TEXT NOT NULL,
-                    session_id TEXT,
-                    user_message TEXT NOT NULL,
-                    assistant_response TEXT NOT NULL,
-                    context_summary TEXT,
-                    importance_score REAL DEFAULT 1.0,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS memory_summaries (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    summary_text TEXT NOT NULL,
-                    start_timestamp TEXT,
-                    end_timestamp TEXT,
-                    conversation_count INTEGER,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_profile (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL,
-                    last_updated TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            conn.commit()
+        with self._lock:
+            init_schema(self._conn)
+
+    @contextmanager
+    def _transaction(self):
+        """Run the enclosed statements as a single transaction (lock must be held)"""
+        # IMMEDIATE takes the write lock up front: a writer in another process
+        # (memory_system.py shares this file) waits at BEGIN rather than
+        # hitting SQLITE_BUSY halfway through the transaction
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        else:
+            self._conn.execute("COMMIT")
 
     def store_conversation(self, user_msg: str, assistant_msg: str,
-                          session_id: str = "default", importance: float = 1.0) -> int:
-        """Store a conversation exchange"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO conversations
-                (timestamp, session_id, user_message, assistant_response, importance_score)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                datetime.now().isoformat(),
+                          session_id: str = "default", importance: float = 1.0,
+                          profile_updates: Optional[List[tuple]] = None) -> int:
+        """Store a conversation exchange and its (key, value) profile updates in one transaction"""
+        now = current_timestamp()
+        with self._lock, self._transaction() as conn:
+            cursor = conn.execute(self.STORE_CONVERSATION_SQL, (
+                now,
                 session_id,
                 user_msg,
                 assistant_msg,
                 importance
             ))
-            conn.commit()
+            if profile_updates:
+                conn.executemany(
+                    self.UPDATE_PROFILE_SQL,
+                    [(key, value, now) for key, value in profile_updates]
+                )
             return cursor.lastrowid
 
     def get_recent_conversations(self, limit: int = 10, session_id: str = "default") -> List[Dict]:
         """Get recent conversations"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._conn
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT timestamp, user_message, assistant_response, importance_score
+                SELECT timestamp, user_message, assistant_response, importance_score, id
                 FROM conversations
                 WHERE session_id = ?
-                ORDER BY timestamp DESC
+                ORDER BY id DESC
                 LIMIT ?
             ''', (session_id, limit))
 
@@ -105,22 +120,32 @@ class MemoryDatabase:
                     "timestamp": row[0],
                     "user": row[1],
                     "assistant": row[2],
-                    "importance": row[3]
+                    "importance": row[3],
+                    "id": row[4]
                 }
                 for row in rows
             ]
 
     def search_conversations(self, query: str, limit: int = 5) -> List[Dict]:
-        """Simple text search in conversations"""
-        with sqlite3.connect(self.db_path) as conn:
+        """Full-text search in conversations, best BM25 matches first
+
+        Stopwords and one-letter words are ignored (see memory_search.py).
+        """
+        match_query = fts_match_query(query)
+        if match_query is None:
+            return []
+
+        with self._lock:
+            conn = self._conn
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT timestamp, user_message, assistant_response, importance_score
-                FROM conversations
-                WHERE user_message LIKE ? OR assistant_response LIKE ?
-                ORDER BY importance_score DESC, timestamp DESC
+                SELECT c.timestamp, c.user_message, c.assistant_response, c.importance_score, c.id
+                FROM conversations_fts f
+                JOIN conversations c ON c.id = f.rowid
+                WHERE conversations_fts MATCH ?
+                ORDER BY bm25(conversations_fts), c.importance_score DESC
                 LIMIT ?
-            ''', (f'%{query}%', f'%{query}%', limit))
+            ''', (match_query, limit))
 
             rows = cursor.fetchall()
             return [
@@ -128,33 +153,62 @@ class MemoryDatabase:
                     "timestamp": row[0],
                     "user": row[1],
                     "assistant": row[2],
-                    "importance": row[3]
+                    "importance": row[3],
+                    "id": row[4]
                 }
                 for row in rows
             ]
 
     def update_user_profile(self, key: str, value: str):
         """Update user profile information"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute('''
-                INSERT OR REPLACE INTO user_profile (key, value, last_updated)
-                VALUES (?, ?, ?)
-            ''', (key, value, datetime.now().isoformat()))
-            conn.commit()
+        with self._lock, self._transaction() as conn:
+            conn.execute(self.UPDATE_PROFILE_SQL, (key, value, current_timestamp()))
 
     def get_user_profile(self) -> Dict[str, str]:
         """Get user profile information"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._conn
             cursor = conn.cursor()
             cursor.execute('SELECT key, value FROM user_profile')
             return dict(cursor.fetchall())
 
+    def clear_memory(self):
+        """Delete stored conversations and summaries (the profile is kept)"""
+        with self._lock, self._transaction() as conn:
+            conn.execute("DELETE FROM conversations")
+            conn.execute("DELETE FROM memory_summaries")
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            # Let SQLite refresh any planner statistics this session made stale
+            self._conn.execute("PRAGMA optimize")
+            self._conn.close()
+
 class MemoryServer:
     def __init__(self):
         self.server = Server("memory-server")
         self.db = MemoryDatabase()
         self.current_session = datetime.now().strftime("%Y%m%d_%H%M%S")
 
+        # Hot store: this session's latest exchanges, served from memory; SQLite
+        # is written in the background and only read for search and profile
+        self._hot = deque(maxlen=10)
+        self._pending_writes = set()
+        self._write_lock = asyncio.Lock()  # FIFO, keeps writes in turn order
+
+        # Profile patterns, compiled once; per info type in priority order, so
+        # "me llamo X" wins over "soy Y" wherever each appears in the message
+        self._profile_rx = {
+            info_type: [re.compile(pattern) for pattern in patterns]
+            for info_type, patterns in {
+                "name": [r"mi nombre es (\w+)", r"me llamo (\w+)", r"soy (\w+)"],
+                "age": [r"tengo (\d+) años", r"mi edad es (\d+)"],
+                "profession": [r"soy (\w+)", r"trabajo como (\w+)", r"estudio (\w+)"],
+                "location": [r"vivo en (\w+)", r"soy de (\w+)"],
+            }.items()
+        }
+
         # Register tools
         self.server.list_tools = self.list_tools
         self.server.call_tool = self.call_tool
@@ -177,7 +231,7 @@ class MemoryServer:
             ),
             Tool(
                 name="get_context",
-                description="Get relevant conversation context",
+                description="Get relevant conversation context: stable context (for the system instruction), then the prompt",
                 inputSchema={
                     "type": "object",
                     "properties": {
@@ -265,61 +319,126 @@ class MemoryServer:
         importance = args.get("importance", 1.0)
 
         # Extract important information for profile
-        await self._extract_profile_info(user_msg)
+        profile_updates = self._extract_profile_info(user_msg)
+
+        # Visible to get_context right away, persisted in the background
+        entry = {
+            "timestamp": current_timestamp(),
+            "user": user_msg,
+            "assistant": assistant_msg,
+            "importance": importance,
+            "id": None
+        }
+        self._hot.append(entry)
 
-        # Store conversation
-        conv_id = self.db.store_conversation(
-            user_msg, assistant_msg, self.current_session, importance
-        )
+        task = asyncio.create_task(self._persist_conversation(entry, profile_updates))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._pending_writes.discard)
 
         return CallToolResult(
             content=[TextContent(
                 type="text",
-                text=f"Stored conversation #{conv_id} successfully"
+                text="Stored conversation successfully"
             )]
         )
 
+    async def _persist_conversation(self, entry: Dict[str, Any], profile_updates: List[tuple]):
+        """Write a hot-store entry and its profile updates to SQLite"""
+        try:
+            # Store conversation and profile updates together
+            async with self._write_lock:
+                entry["id"] = await asyncio.to_thread(
+                    self.db.store_conversation,
+                    entry["user"], entry["assistant"], self.current_session,
+                    entry["importance"], profile_updates
+                )
+        except Exception as e:
+            logger.error(f"Error storing conversation: {e}")
+
+    async def wait_pending_writes(self):
+        """Wait for background conversation writes to reach SQLite"""
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes)
+
     async def _get_context(self, args: Dict[str, Any]) -> CallToolResult:
         """Get relevant context for current message"""
         current_msg = args["current_message"]
         context_limit = args.get("context_limit", 5)
 
-        # Get recent conversations
-        recent = self.db.get_recent_conversations(limit=context_limit)
+        # Last exchanges of this session straight from the hot store
+        recent_count = min(int(context_limit), 3)  # Last 3 exchanges, oldest first
+        recent = list(self._hot)[-recent_count:] if recent_count > 0 else []
+        # By content: hot entries still being written have no id yet
+        seen = {(conv["user"], conv["assistant"]) for conv in recent}
 
         # Get user profile
-        profile = self.db.get_user_profile()
+        profile = await asyncio.to_thread(self.db.get_user_profile)
+
+        # Relevant hits not already among the recent exchanges; none at all if
+        # the message itself is part of a recent exchange
+        msg_lower = current_msg.lower()
+        if any(
+            msg_lower in conv["user"].lower() or msg_lower in conv["assistant"].lower()
+            for conv in recent
+        ):
+            relevant = []
+        else:
+            # Search relevant past conversations (meaningful messages only)
+            hits = []
+            if len(current_msg) >= 20:
+                hits = await asyncio.to_thread(self.db.search_conversations, current_msg, limit=2)
+            relevant = [conv for conv in hits if (conv["user"], conv["assistant"]) not in seen]
+
+        profile_text = ", ".join([f"{k}: {v}" for k, v in profile.items()])
+
+        # Stay within the character budget: drop search hits first, then the
+        # oldest recent exchanges
+        def context_chars():
+            return len(profile_text) + sum(
+                len(conv["user"]) + len(conv["assistant"]) for conv in recent + relevant
+            )
 
-        # Build context
-        context_parts = []
+        while (recent or relevant) and context_chars() > CONTEXT_CHAR_BUDGET:
+            if relevant:
+                relevant.pop()
+            else:
+                recent.pop(0)
+
+        # Build context in two parts: a stable one (profile + recent exchanges)
+        # that only changes after a store, meant for the system instruction so
+        # Gemini can reuse its prefix, and the per-message prompt
+        stable_parts = []
 
         if profile:
-            profile_text = ", ".join([f"{k}: {v}" for k, v in profile.items()])
-            context_parts.append(f"Información del usuario: {profile_text}")
+            stable_parts.append(f"Información del usuario: {profile_text}")
 
         if recent:
-            context_parts.append("Conversación reciente:")
-            for conv in reversed(recent[-3:]):  # Last 3 exchanges
-                context_parts.append(f"Usuario: {conv['user']}")
-                context_parts.append(f"Asistente: {conv['assistant']}")
-
-        # Search for relevant past conversations
-        if len(current_msg) > 10:  # Only search for meaningful messages
-            relevant = self.db.search_conversations(current_msg, limit=2)
-            if relevant:
-                context_parts.append("Conversaciones relevantes anteriores:")
-                for conv in relevant:
-                    context_parts.append(f"Usuario: {conv['user']}")
-                    context_parts.append(f"Asistente: {conv['assistant']}")
-
-        context = "\n".join(context_parts)
-        if context:
-            context += f"\n\nUsuario actual: {current_msg}\n\nResponde al usuario actual teniendo en cuenta toda la información anterior:"
+            stable_parts.append("Conversación reciente:")
+            for conv in recent:
+                stable_parts.append(f"Usuario: {conv['user']}")
+                stable_parts.append(f"Asistente: {conv['assistant']}")
+
+        dynamic_parts = []
+
+        if relevant:
+            dynamic_parts.append("Conversaciones relevantes anteriores:")
+            for conv in relevant:
+                dynamic_parts.append(f"Usuario: {conv['user']}")
+                dynamic_parts.append(f"Asistente: {conv['assistant']}")
+
+        stable_context = "\n".join(stable_parts)
+        prompt = "\n".join(dynamic_parts)
+        if stable_context or prompt:
+            prompt += f"\n\nUsuario actual: {current_msg}\n\nResponde al usuario actual teniendo en cuenta toda la información anterior:"
+            prompt = prompt.lstrip()
         else:
-            context = current_msg
+            prompt = current_msg
 
         return CallToolResult(
-            content=[TextContent(type="text", text=context)]
+            content=[
+                TextContent(type="text", text=stable_context),
+                TextContent(type="text", text=prompt)
+            ]
         )
 
     async def _search_memory(self, args: Dict[str, Any]) -> CallToolResult:
@@ -327,7 +446,7 @@ class MemoryServer:
         query = args["query"]
         limit = args.get("limit", 5)
 
-        results = self.db.search_conversations(query, limit)
+        results = await asyncio.to_thread(self.db.search_conversations, query, limit)
 
         if not results:
             return CallToolResult(
@@ -349,7 +468,7 @@ class MemoryServer:
         key = args["key"]
         value = args["value"]
 
-        self.db.update_user_profile(key, value)
+        await asyncio.to_thread(self.db.update_user_profile, key, value)
 
         return CallToolResult(
             content=[TextContent(type="text", text=f"Updated profile: {key} = {value}")]
@@ -357,7 +476,7 @@ class MemoryServer:
 
     async def _get_profile(self, args: Dict[str, Any]) -> CallToolResult:
         """Get user profile"""
-        profile = self.db.get_user_profile()
+        profile = await asyncio.to_thread(self.db.get_user_profile)
 
         if not profile:
             return CallToolResult(
@@ -379,37 +498,29 @@ class MemoryServer:
             )
 
         # Clear database
-        with sqlite3.connect(self.db.db_path) as conn:
-            conn.execute("DELETE FROM conversations")
-            conn.execute("DELETE FROM memory_summaries")
-            conn.commit()
+        self._hot.clear()
+        await self.wait_pending_writes()
+        await asyncio.to_thread(self.db.clear_memory)
 
         return CallToolResult(
             content=[TextContent(type="text", text="Memory cleared successfully")]
         )
 
-    async def _extract_profile_info(self, user_message: str):
-        """Extract important user information from messages"""
+    def _extract_profile_info(self, user_message: str) -> List[tuple]:
+        """Extract important user information from messages as (key, value) pairs"""
         msg_lower = user_message.lower()
+        updates = []
 
         # Simple pattern matching for common information
-        patterns = {
-            "name": [r"mi nombre es (\w+)", r"me llamo (\w+)", r"soy (\w+)"],
-            "age": [r"tengo (\d+) años", r"mi edad es (\d+)"],
-            "profession": [r"soy (\w+)", r"trabajo como (\w+)", r"estudio (\w+)"],
-            "location": [r"vivo en (\w+)", r"soy de (\w+)"],
-        }
-
-        import re
-
-        for info_type, pattern_list in patterns.items():
-            for pattern in pattern_list:
-                match = re.search(pattern, msg_lower)
+        for info_type, patterns in self._profile_rx.items():
+            for rx in patterns:
+                match = rx.search(msg_lower)
                 if match:
-                    value = match.group(1)
-                    self.db.update_user_profile(info_type, value)
+                    updates.append((info_type, match.group(1)))
                     break
 
+        return updates
+
 async def main():
     """Run the MCP Memory Server"""
     memory_server = MemoryServer()
@@ -420,6 +531,9 @@ async def main():
         await memory_server.server.run()
     except KeyboardInterrupt:
         logger.info("Shutting down MCP Memory Server...")
+    finally:
+        await memory_server.wait_pending_writes()
+        memory_server.db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
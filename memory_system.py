@@ -3,173 +3,345 @@
 import asyncio
 import json
 import sqlite3
-import numpy as np
+import threading
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, NamedTuple, Optional, Tuple
 import logging
 import re
+from contextlib import contextmanager
+
+from memory_search import current_timestamp, fts_match_query, init_schema
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Phrasings that reveal profile facts, each with the info types its captured
+# word fills and that phrasing's priority for the type (0 = most explicit):
+# "me llamo Pedro" beats "soy ingeniero" for the name wherever it appears.
+# "soy de" comes before "soy" so a hometown isn't read as a name
+PROFILE_PHRASES = [
+    (r"mi nombre es (\w+)", {"name": 0}),
+    (r"me llamo (\w+)", {"name": 1}),
+    (r"soy de (\w+)", {"location": 1}),
+    (r"soy (\w+)", {"name": 2, "profession": 0}),
+    (r"tengo (\d+) años", {"age": 0}),
+    (r"mi edad es (\d+)", {"age": 1}),
+    (r"trabajo como (\w+)", {"profession": 1}),
+    (r"estudio (\w+)", {"profession": 2}),
+    (r"vivo en (\w+)", {"location": 0}),
+]
+
+# All phrasings as one alternation, scanned once per message; phrase i owns
+# capture group i + 1, so match.lastindex says which one matched
+PROFILE_PATTERN = re.compile("|".join(phrase for phrase, _ in PROFILE_PHRASES))
+PROFILE_PRIORITIES = [priorities for _, priorities in PROFILE_PHRASES]
+
+# Closes every non-empty context: the message being answered and the instruction
+PROMPT_SUFFIX = "\n\nUsuario actual: {msg}\n\nResponde al usuario actual teniendo en cuenta toda la información anterior:"
+
+class ConvRow(NamedTuple):
+    """One stored exchange, in the column order the conversation queries select"""
+    timestamp: str
+    user: str
+    assistant: str
+    importance: float
+    id: int
+
+
+# INSERT ... RETURNING needs SQLite 3.35+; older builds read cursor.lastrowid
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
 class MemoryDatabase:
+    STORE_CONVERSATION_SQL = '''
+        INSERT INTO conversations
+        (timestamp, session_id, user_message, assistant_response, importance_score)
+        VALUES (?, ?, ?, ?, ?)
+    '''
+    UPDATE_PROFILE_SQL = '''
+        INSERT OR REPLACE INTO user_profile (key, value, last_updated)
+        VALUES (?, ?, ?)
+    '''
+    SEARCH_SQL = '''
+        SELECT c.timestamp, c.user_message, c.assistant_response, c.importance_score, c.id
+        FROM conversations_fts f
+        JOIN conversations c ON c.id = f.rowid
+        WHERE conversations_fts MATCH ?
+        ORDER BY bm25(conversations_fts), c.importance_score DESC
+        LIMIT ?
+    '''
+    # The two halves of get_context_rows; each is wrapped in a subquery so it
+    # keeps its own ORDER BY / LIMIT inside the UNION ALL
+    CONTEXT_RECENT_SQL = '''
+        SELECT * FROM (
+            SELECT 'recent' AS src, timestamp, user_message, assistant_response,
+                   importance_score, id
+            FROM conversations
+            WHERE session_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+        )
+    '''
+    CONTEXT_MATCH_SQL = '''
+        SELECT * FROM (
+            SELECT 'match' AS src, c.timestamp, c.user_message, c.assistant_response,
+                   c.importance_score, c.id
+            FROM conversations_fts f
+            JOIN conversations c ON c.id = f.rowid
+            WHERE conversations_fts MATCH ?
+            ORDER BY bm25(conversations_fts), c.importance_score DESC
+            LIMIT ?
+        )
+    '''
+
     def __init__(self, db_path: str = "data/memory/conversation.db"):
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # One connection for the lifetime of the database object (autocommit,
+        # WAL so readers don't block the writer, ~20 MB page cache)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute("PRAGMA cache_size=-20000")
+
+        # The connection is shared across threads; one method at a time
+        self._lock = threading.Lock()
+
+        # The profile, read on every turn, cached and updated by this object's
+        # own writes (the lock also guards it). memory_server.py writes the
+        # same file from another process; PRAGMA data_version changes when
+        # any other connection commits, and then the cache is dropped
+        self._profile_cache: Optional[Dict[str, str]] = None
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
         self.init_database()
 
     def init_database(self):
         """Initialize SQLite database with required tables"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp TEXT NOT NULL,
-                    session_id TEXT,
-                    user_message TEXT NOT NULL,
-                    assistant_response TEXT NOT NULL,
-                    context_summary TEXT,
-                    importance_score REAL DEFAULT 1.0,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS memory_summaries (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    summary_text TEXT NOT NULL,
-                    start_timestamp TEXT,
-                    end_timestamp TEXT,
-                    conversation_count INTEGER,
-                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_profile (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL,
-                    last_updated TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            conn.commit()
+        with self._lock:
+            init_schema(self._conn)
+
+    @contextmanager
+    def _transaction(self):
+        """Run the enclosed statements as one write transaction (lock must be held)"""
+        # IMMEDIATE takes the write lock up front: a writer in another process
+        # (memory_server.py shares this file and opens its write transactions
+        # the same way) waits at BEGIN rather than hitting SQLITE_BUSY halfway
+        # through the transaction
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
 
     def store_conversation(self, user_msg: str, assistant_msg: str,
-                          session_id: str = "default", importance: float = 1.0) -> int:
-        """Store a conversation exchange"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO conversations
-                (timestamp, session_id, user_message, assistant_response, importance_score)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                datetime.now().isoformat(),
+                          session_id: str = "default", importance: float = 1.0,
+                          profile_updates: Optional[List[tuple]] = None) -> int:
+        """Store a conversation exchange and its (key, value) profile updates in one transaction"""
+        now = current_timestamp()
+        sql = self.STORE_CONVERSATION_SQL
+        if SQLITE_HAS_RETURNING:
+            sql += " RETURNING id"
+        with self._lock, self._transaction() as conn:
+            cursor = conn.execute(sql, (
+                now,
                 session_id,
                 user_msg,
                 assistant_msg,
                 importance
             ))
-            conn.commit()
-            return cursor.lastrowid
+            conv_id = cursor.fetchone()[0] if SQLITE_HAS_RETURNING else cursor.lastrowid
+            if profile_updates:
+                conn.executemany(
+                    self.UPDATE_PROFILE_SQL,
+                    [(key, value, now) for key, value in profile_updates]
+                )
+                if self._profile_cache is not None:
+                    self._profile_cache.update(profile_updates)
+            return conv_id
+
+    def store_conversations_bulk(self, rows: List[tuple]) -> int:
+        """Store many (timestamp, session_id, user_msg, assistant_msg, importance)
+        exchanges in a single transaction, returning how many were written"""
+        # Each row keeps its own timestamp (e.g. from the log being imported),
+        # and rows are inserted in order, so ids follow the input's time order
+        with self._lock, self._transaction() as conn:
+            return conn.executemany(self.STORE_CONVERSATION_SQL, rows).rowcount
 
     def get_recent_conversations(self, limit: int = 10, session_id: str = "default") -> List[Dict]:
         """Get recent conversations"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._conn
             cursor = conn.cursor()
             cursor.execute('''
-                SELECT timestamp, user_message, assistant_response, importance_score
+                SELECT timestamp, user_message, assistant_response, importance_score, id
                 FROM conversations
                 WHERE session_id = ?
-                ORDER BY timestamp DESC
+                ORDER BY id DESC
                 LIMIT ?
             ''', (session_id, limit))
 
-            rows = cursor.fetchall()
+            # Dicts straight from the row tuples, no ConvRow in between
             return [
-                {
-                    "timestamp": row[0],
-                    "user": row[1],
-                    "assistant": row[2],
-                    "importance": row[3]
-                }
-                for row in rows
+                {"timestamp": row[0], "user": row[1], "assistant": row[2],
+                 "importance": row[3], "id": row[4]}
+                for row in cursor
             ]
 
-    def search_conversations(self, query: str, limit: int = 5) -> List[Dict]:
-        """Simple text search in conversations"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT timestamp, user_message, assistant_response, importance_score
-                FROM conversations
-                WHERE user_message LIKE ? OR assistant_response LIKE ?
-                ORDER BY importance_score DESC, timestamp DESC
-                LIMIT ?
-            ''', (f'%{query}%', f'%{query}%', limit))
+    def search_conversations(self, query: str, limit: int = 5,
+                             skip_stopwords: bool = True) -> List[Dict]:
+        """Full-text search in conversations, best BM25 matches first
+
+        Stopwords and one-letter words are ignored, and a query made only of
+        them returns no results without touching the database; pass
+        skip_stopwords=False to search for every word.
+        """
+        match_query = fts_match_query(query, skip_stopwords)
+        if not match_query:
+            return []
 
-            rows = cursor.fetchall()
+        with self._lock:
+            cursor = self._conn.execute(self.SEARCH_SQL, (match_query, limit))
             return [
-                {
-                    "timestamp": row[0],
-                    "user": row[1],
-                    "assistant": row[2],
-                    "importance": row[3]
-                }
-                for row in rows
+                {"timestamp": row[0], "user": row[1], "assistant": row[2],
+                 "importance": row[3], "id": row[4]}
+                for row in cursor
             ]
 
+    def search_conversation_rows(self, query: str, limit: int = 5,
+                                 skip_stopwords: bool = True) -> List[ConvRow]:
+        """Like search_conversations, but as ConvRow tuples"""
+        match_query = fts_match_query(query, skip_stopwords)
+        if not match_query:
+            return []
+
+        with self._lock:
+            cursor = self._conn.execute(self.SEARCH_SQL, (match_query, limit))
+            return list(map(ConvRow._make, cursor))
+
+    def get_context_rows(self, session_id: str, query: Optional[str],
+                         recent_limit: int = 3,
+                         search_limit: int = 2) -> Tuple[List[ConvRow], List[ConvRow]]:
+        """The session's most recent exchanges and the best search hits for query,
+        fetched in one statement, as (recent, matches)"""
+        match_query = fts_match_query(query) if query else None
+
+        with self._lock:
+            conn = self._conn
+            if match_query:
+                cursor = conn.execute(
+                    f"{self.CONTEXT_RECENT_SQL} UNION ALL {self.CONTEXT_MATCH_SQL}",
+                    (session_id, recent_limit, match_query, search_limit)
+                )
+            else:
+                cursor = conn.execute(self.CONTEXT_RECENT_SQL, (session_id, recent_limit))
+
+            # Each row leads with its src column, the rest is a ConvRow
+            recent, matches = [], []
+            for row in cursor:
+                (recent if row[0] == "recent" else matches).append(ConvRow._make(row[1:]))
+            return recent, matches
+
     def update_user_profile(self, key: str, value: str):
         """Update user profile information"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute('''
-                INSERT OR REPLACE INTO user_profile (key, value, last_updated)
-                VALUES (?, ?, ?)
-            ''', (key, value, datetime.now().isoformat()))
-            conn.commit()
+        with self._lock, self._transaction() as conn:
+            conn.execute(self.UPDATE_PROFILE_SQL, (key, value, current_timestamp()))
+            if self._profile_cache is not None:
+                self._profile_cache[key] = value
 
     def get_user_profile(self) -> Dict[str, str]:
         """Get user profile information"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT key, value FROM user_profile')
-            return dict(cursor.fetchall())
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != self._data_version:
+                self._data_version = data_version
+                self._profile_cache = None
+
+            if self._profile_cache is None:
+                conn = self._conn
+                cursor = conn.cursor()
+                cursor.execute('SELECT key, value FROM user_profile')
+                self._profile_cache = dict(cursor.fetchall())
+            return dict(self._profile_cache)
 
     def clear_memory(self):
         """Clear all conversation data"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock, self._transaction() as conn:
             conn.execute("DELETE FROM conversations")
             conn.execute("DELETE FROM memory_summaries")
-            conn.commit()
+
+    def optimize(self):
+        """Merge the FTS index segments and refresh the query planner statistics"""
+        with self._lock, self._transaction() as conn:
+            conn.execute("INSERT INTO conversations_fts (conversations_fts) VALUES ('optimize')")
+            conn.execute("ANALYZE")
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            # Let SQLite refresh any planner statistics this session made stale
+            self._conn.execute("PRAGMA optimize")
+            self._conn.close()
 
 class MemoryManager:
     def __init__(self):
         self.db = MemoryDatabase()
         self.current_session = datetime.now().strftime("%Y%m%d_%H%M%S")
 
+        # Database calls run in worker threads; writes queue here (FIFO) so
+        # they reach SQLite in the order they were made
+        self._write_lock = asyncio.Lock()
+
+        # Every optimize_every stored exchanges, compact the search index and
+        # re-analyze the tables in the background
+        self.optimize_every = 1000
+        self._writes_since_optimize = 0
+        self._background_tasks = set()
+
     async def store_conversation(self, user_message: str, assistant_response: str, importance: float = 1.0) -> str:
         """Store a conversation exchange"""
-        # Extract important information for profile
-        await self._extract_profile_info(user_message)
+        # Extract important information for profile, stored with the exchange
+        profile_updates = self._extract_profile_info(user_message)
 
         # Store conversation
-        conv_id = self.db.store_conversation(
-            user_message, assistant_response, self.current_session, importance
-        )
+        async with self._write_lock:
+            conv_id = await asyncio.to_thread(
+                self.db.store_conversation,
+                user_message, assistant_response, self.current_session, importance,
+                profile_updates
+            )
+
+        self._writes_since_optimize += 1
+        if self._writes_since_optimize >= self.optimize_every:
+            self._writes_since_optimize = 0
+            task = asyncio.create_task(self._optimize())
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
 
         return f"Stored conversation #{conv_id} successfully"
 
     async def get_context(self, current_message: str, context_limit: int = 5) -> str:
         """Get relevant context for current message"""
-        # Get recent conversations
-        recent = self.db.get_recent_conversations(limit=context_limit)
+        # Recent conversations (newest first, only the last 3 are shown) and,
+        # for meaningful messages, relevant past ones, in a single query
+        search_query = current_message if len(current_message) > 10 else None
+        recent_limit = min(context_limit, 3)
+        recent, relevant = await asyncio.to_thread(
+            self.db.get_context_rows,
+            self.current_session, search_query, recent_limit, 2 + recent_limit
+        )
+        # A hit that is also a recent exchange is already in the prompt; the
+        # search over-fetches so 2 hits remain after dropping those
+        recent_ids = {conv.id for conv in recent}
+        relevant = [conv for conv in relevant if conv.id not in recent_ids][:2]
 
         # Get user profile
-        profile = self.db.get_user_profile()
+        profile = await asyncio.to_thread(self.db.get_user_profile)
 
         # Build context
         context_parts = []
@@ -180,22 +352,18 @@ class MemoryManager:
 
         if recent:
             context_parts.append("Conversación reciente:")
-            for conv in reversed(recent[-3:]):  # Last 3 exchanges
-                context_parts.append(f"Usuario: {conv['user']}")
-                context_parts.append(f"Asistente: {conv['assistant']}")
-
-        # Search for relevant past conversations
-        if len(current_message) > 10:  # Only search for meaningful messages
-            relevant = self.db.search_conversations(current_message, limit=2)
-            if relevant:
-                context_parts.append("Conversaciones relevantes anteriores:")
-                for conv in relevant:
-                    context_parts.append(f"Usuario: {conv['user']}")
-                    context_parts.append(f"Asistente: {conv['assistant']}")
-
-        context = "\n".join(context_parts)
-        if context:
-            context += f"\n\nUsuario actual: {current_message}\n\nResponde al usuario actual teniendo en cuenta toda la información anterior:"
+            for conv in reversed(recent):  # Oldest of the last 3 first
+                context_parts.append(f"Usuario: {conv.user}")
+                context_parts.append(f"Asistente: {conv.assistant}")
+
+        if relevant:
+            context_parts.append("Conversaciones relevantes anteriores:")
+            for conv in relevant:
+                context_parts.append(f"Usuario: {conv.user}")
+                context_parts.append(f"Asistente: {conv.assistant}")
+
+        if context_parts:
+            context = "\n".join(context_parts) + PROMPT_SUFFIX.format(msg=current_message)
         else:
             context = current_message
 
@@ -203,27 +371,28 @@ class MemoryManager:
 
     async def search_memory(self, query: str, limit: int = 5) -> str:
         """Search conversation memory"""
-        results = self.db.search_conversations(query, limit)
+        results = await asyncio.to_thread(self.db.search_conversation_rows, query, limit)
 
         if not results:
             return "No conversations found"
 
         search_results = []
         for conv in results:
-            search_results.append(f"[{conv['timestamp']}] Usuario: {conv['user']}")
-            search_results.append(f"Asistente: {conv['assistant']}")
+            search_results.append(f"[{conv.timestamp}] Usuario: {conv.user}")
+            search_results.append(f"Asistente: {conv.assistant}")
             search_results.append("---")
 
         return "\n".join(search_results)
 
     async def update_profile(self, key: str, value: str) -> str:
         """Update user profile"""
-        self.db.update_user_profile(key, value)
+        async with self._write_lock:
+            await asyncio.to_thread(self.db.update_user_profile, key, value)
         return f"Updated profile: {key} = {value}"
 
     async def get_profile(self) -> str:
         """Get user profile"""
-        profile = self.db.get_user_profile()
+        profile = await asyncio.to_thread(self.db.get_user_profile)
 
         if not profile:
             return "No profile information stored"
@@ -232,25 +401,33 @@ class MemoryManager:
 
     async def clear_memory(self) -> str:
         """Clear conversation memory"""
-        self.db.clear_memory()
+        async with self._write_lock:
+            await asyncio.to_thread(self.db.clear_memory)
         return "Memory cleared successfully"
 
-    async def _extract_profile_info(self, user_message: str):
-        """Extract important user information from messages"""
+    def close(self):
+        """Close the database (runs PRAGMA optimize first); call once on shutdown"""
+        self.db.close()
+
+    async def _optimize(self):
+        """Database maintenance, queued behind pending writes"""
+        try:
+            async with self._write_lock:
+                await asyncio.to_thread(self.db.optimize)
+        except sqlite3.Error as e:
+            logger.warning(f"Memory optimize failed: {e}")
+
+    def _extract_profile_info(self, user_message: str) -> List[tuple]:
+        """Extract important user information from messages as (key, value) pairs"""
         msg_lower = user_message.lower()
+        best = {}  # info_type -> (priority, value)
+
+        # Simple pattern matching for common information; per info type the
+        # highest-priority phrasing wins, then its first mention
+        for match in PROFILE_PATTERN.finditer(msg_lower):
+            value = match.group(match.lastindex)
+            for info_type, priority in PROFILE_PRIORITIES[match.lastindex - 1].items():
+                if info_type not in best or priority < best[info_type][0]:
+                    best[info_type] = (priority, value)
 
-        # Simple pattern matching for common information
-        patterns = {
-            "name": [r"mi nombre es (\w+)", r"me llamo (\w+)", r"soy (\w+)"],
-            "age": [r"tengo (\d+) años", r"mi edad es (\d+)"],
-            "profession": [r"soy (\w+)", r"trabajo como (\w+)", r"estudio (\w+)"],
-            "location": [r"vivo en (\w+)", r"soy de (\w+)"],
-        }
-
-        for info_type, pattern_list in patterns.items():
-            for pattern in pattern_list:
-                match = re.search(pattern, msg_lower)
-                if match:
-                    value = match.group(1)
-                    self.db.update_user_profile(info_type, value)
-                    break
\ No newline at end of file
+        return [(info_type, value) for info_type, (_, value) in best.items()]
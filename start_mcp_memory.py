@@ -10,11 +10,10 @@ async def start_memory_server():
     """Start the MCP Memory Server"""
     print("🚀 Iniciando servidor de memoria MCP...")
 
-    # Start the memory server
+    # Start the memory server; it shares this terminal's stdio, so its logs
+    # show up as they're written instead of piling up in a pipe buffer
     process = await asyncio.create_subprocess_exec(
-        sys.executable, "memory_server.py",
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
+        sys.executable, "memory_server.py"
     )
 
     print(f"📡 Servidor MCP iniciado con PID: {process.pid}")
@@ -22,12 +21,10 @@ async def start_memory_server():
 
     try:
         # Wait for the process to complete
-        stdout, stderr = await process.communicate()
+        returncode = await process.wait()
 
-        if stdout:
-            print("📝 Stdout:", stdout.decode())
-        if stderr:
-            print("❌ Stderr:", stderr.decode())
+        if returncode:
+            print(f"❌ Servidor MCP terminó con código {returncode}")
 
     except KeyboardInterrupt:
         print("\n⏹️ Deteniendo servidor MCP...")
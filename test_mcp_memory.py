@@ -68,10 +68,48 @@ async def test_memory_database():
         cursor.execute("SELECT COUNT(*) FROM user_profile")
         profile_count = cursor.fetchone()[0]
         print(f"   Elementos en perfil: {profile_count}")
+    conn.close()
 
     print("\n✅ Todas las pruebas completadas exitosamente!")
 
     # Cleanup
+    db.close()
+    db.db_path.unlink()
+    print("🧹 Base de datos de prueba eliminada")
+
+async def test_bulk_store():
+    """Test the advanced memory's bulk insert path"""
+    print("\n📦 Probando inserción masiva (memoria avanzada)...")
+
+    from memory_system import MemoryDatabase as AdvancedMemoryDatabase
+
+    db = AdvancedMemoryDatabase("data/memory/test_bulk.db")
+
+    rows = [
+        ("2024-01-01T10:00:00", "bulk_session", "Me gusta tocar la guitarra", "¡Qué bien! ¿Desde cuándo tocas?", 1.0),
+        ("2024-01-01T10:05:00", "bulk_session", "Desde hace cinco años", "Eso es bastante tiempo.", 1.0),
+        ("2024-01-02T09:30:00", "bulk_session", "Ayer compré una guitarra eléctrica", "¡Felicidades por tu guitarra!", 1.5),
+    ]
+    written = db.store_conversations_bulk(rows)
+    print(f"   Filas escritas: {written}")
+    assert written == len(rows)
+
+    # Rows come back newest first, each with the timestamp it was given
+    recent = db.get_recent_conversations(limit=5, session_id="bulk_session")
+    for conv in recent:
+        print(f"   [{conv['timestamp']}] Usuario: {conv['user']}")
+    assert [conv['timestamp'] for conv in recent] == [row[0] for row in reversed(rows)]
+    assert [conv['user'] for conv in recent] == [row[2] for row in reversed(rows)]
+
+    # The insert triggers indexed every row for full-text search
+    results = db.search_conversations("guitarra", limit=5)
+    print(f"   Encontradas {len(results)} conversaciones con 'guitarra'")
+    assert sorted(conv['user'] for conv in results) == sorted([rows[0][2], rows[2][2]])
+
+    print("\n✅ Inserción masiva verificada!")
+
+    # Cleanup
+    db.close()
     db.db_path.unlink()
     print("🧹 Base de datos de prueba eliminada")
 
@@ -98,6 +136,7 @@ async def main():
 
     try:
         await test_memory_database()
+        await test_bulk_store()
         await test_memory_server_tools()
 
         print("\n🎉 ¡Todas las pruebas pasaron exitosamente!")